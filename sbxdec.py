@@ -25,10 +25,14 @@
 
 import os
 import sys
+import json
 import hashlib
 import argparse
 import binascii
 import time
+import zlib
+import lzma
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 import seqbox
 
@@ -55,6 +59,19 @@ def get_cmdline():
                         help="continue on block errors", dest="cont")
     parser.add_argument("-o", "--overwrite", action="store_true", default=False,
                         help="overwrite existing file")
+    parser.add_argument("-m", "--missing", action="store", metavar="filename",
+                        help="save the list of missing blocks (JSON)")
+    parser.add_argument("--patch", action="store", metavar="filename",
+                        help=("fill the missing blocks listed in this file " +
+                              "using another copy of the container"))
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="worker processes, using the hash tree",
+                        metavar="n")
+    parser.add_argument("-s", "--sparse", action="store_true", default=False,
+                        help="write blocks of zeros as holes")
+    parser.add_argument("-st", "--stripe", action="store", nargs="+",
+                        metavar="filename", default=[],
+                        help="other members of a striped SBX container")
     parser.add_argument("-p", "--password", type=str, default="",
                         help="encrypt with password", metavar="pass")
     res = parser.parse_args()
@@ -78,9 +95,431 @@ def lastEofCount(data):
     return count
 
 
+def getranges(numbers):
+    """Compact a sorted list of numbers in a list of [first, last] ranges"""
+    ranges = []
+    for num in numbers:
+        if ranges and ranges[-1][1] == num - 1:
+            ranges[-1][1] = num
+        else:
+            ranges.append([num, num])
+    return ranges
+
+
+def getbyteranges(ranges, datasize, filesize=None):
+    """The [start, end) bytes of ranges of data blocks, up to the file size"""
+    return [[(first-1)*datasize,
+             last*datasize if filesize is None else
+             min(last*datasize, filesize)] for first, last in ranges]
+
+
+def firstvalidblock(sbxfilename, password):
+    """
+    Find the first valid block of a SBX file and its position in blocks,
+    checking for a header every 128 bytes (the smallest block size)
+    """
+    blocksizes = {ver:seqbox.SbxBlock(ver=ver).blocksize
+                  for ver in seqbox.supported_vers}
+    key = b"\x00" * 4
+    if password:
+        key = seqbox.EncDec(password, 4).key.to_bytes(4, byteorder='big')
+    #read in chunks aligned to every block size
+    chunksize = max(blocksizes.values())
+    with open(sbxfilename, "rb") as fin:
+        chunkpos = 0
+        while True:
+            chunk = fin.read(chunksize)
+            if not chunk:
+                return None, 0
+            for p in range(0, len(chunk), 128):
+                header = bytes(a ^ b for a, b in zip(chunk[p:p+4], key))
+                if (header[:3] != b"SBx" or
+                    not header[3] in seqbox.supported_vers or
+                    p % blocksizes[header[3]]):
+                    continue
+                sbx = seqbox.SbxBlock(ver=header[3], pswd=password)
+                try:
+                    sbx.decode(chunk[p:p+sbx.blocksize])
+                except seqbox.SbxDecodeError:
+                    continue
+                return sbx, (chunkpos + p) // sbx.blocksize
+            chunkpos += len(chunk)
+
+
+def getstripes(sbxfilenames, password):
+    """
+    Sort the members of a stripe set using their first block numbers, and
+    get the size of the extents they are striped in. A member with damaged
+    first blocks is placed from its first valid one, if still in the first
+    extent.
+    """
+    firstblocks = {}
+    empty = []
+    uids = set()
+    for sbxfilename in sbxfilenames:
+        if not os.path.exists(sbxfilename):
+            errexit(1, "sbx file '%s' not found" % (sbxfilename))
+        if os.path.getsize(sbxfilename) == 0:
+            #too few blocks to fill all the members
+            empty.append(sbxfilename)
+            continue
+        sbx, index = firstvalidblock(sbxfilename, password)
+        if sbx is None:
+            errexit(1, "no valid blocks in stripe '%s'!" % (sbxfilename))
+        firstblocks[sbxfilename] = sbx.blocknum - index
+        uids.add(sbx.uid)
+    if len(uids) != 1:
+        errexit(1, "stripes from different SBX containers!")
+
+    sbxfilenames = sorted(firstblocks, key=firstblocks.get)
+    base = firstblocks[sbxfilenames[0]]
+    if base > 1:
+        errexit(1, "first stripe missing!")
+    if len(sbxfilenames) == 1:
+        extent = max(os.path.getsize(sbxfilenames[0]), sbx.blocksize)
+    else:
+        extblocks = firstblocks[sbxfilenames[1]] - base
+        for count, sbxfilename in enumerate(sbxfilenames):
+            if firstblocks[sbxfilename] != base + count * extblocks:
+                errexit(1, "stripe '%s' out of place!" % (sbxfilename))
+        extent = extblocks * sbx.blocksize
+    return sbxfilenames + empty, extent
+
+
+def savemissing(missfilename, sbx, metadata, filename, missing):
+    """Save the list of the missing blocks, to be used with --patch"""
+    info = {"filename":os.path.abspath(filename) if filename else None,
+            "uid":binascii.hexlify(sbx.uid).decode(),
+            "ver":sbx.ver,
+            "datasize":sbx.datasize,
+            "compressed":"compress" in metadata,
+            "missing":missing,
+            "missingbytes":getbyteranges(missing, sbx.datasize,
+                                         metadata.get("filesize"))}
+    if "filesize" in metadata:
+        info["filesize"] = metadata["filesize"]
+    if "hash" in metadata:
+        info["hash"] = binascii.hexlify(metadata["hash"]).decode()
+    with open(missfilename, "w") as fmiss:
+        json.dump(info, fmiss, indent=2)
+    print("missing blocks list saved to '%s'" % (missfilename))
+
+
+def patch(cmdline):
+    """Fill in the missing blocks of a decoded file using another copy"""
+    with open(cmdline.patch) as fmiss:
+        info = json.load(fmiss)
+    if info.get("compressed"):
+        errexit(1, "compressed containers can't be patched!")
+    sbxfilename = cmdline.sbxfilename
+    filename = cmdline.filename if cmdline.filename else info["filename"]
+    if not filename:
+        errexit(1, "no target file to patch!")
+    if not os.path.exists(sbxfilename):
+        errexit(1, "sbx file '%s' not found" % (sbxfilename))
+    if not os.path.exists(filename):
+        errexit(1, "target file '%s' not found" % (filename))
+    extent = 0
+    if cmdline.stripe:
+        sbxfilename, extent = getstripes([sbxfilename] + cmdline.stripe,
+                                         cmdline.password)
+
+    sbx = seqbox.SbxBlock(ver=info["ver"], pswd=cmdline.password)
+    uid = binascii.unhexlify(info["uid"])
+    print("patching '%s' from '%s'..." % (filename, sbxfilename))
+    fin = seqbox.openStripes(sbxfilename, extent, "rb")
+    fout = open(filename, "r+b")
+    missing = []
+    patched = 0
+    for first, last in info["missing"]:
+        for blocknum in range(first, last+1):
+            #the copy could have the metadata block or not
+            for pos in (blocknum, blocknum-1):
+                fin.seek(pos * sbx.blocksize, 0)
+                try:
+                    sbx.decode(fin.read(sbx.blocksize))
+                except seqbox.SbxDecodeError:
+                    continue
+                if sbx.uid == uid and sbx.blocknum == blocknum:
+                    break
+            else:
+                missing.append(blocknum)
+                continue
+            pos = (blocknum - 1) * sbx.datasize
+            if "filesize" in info:
+                sbx.data = sbx.data[:max(0, info["filesize"] - pos)]
+            fout.seek(pos, 0)
+            fout.write(sbx.data)
+            patched += 1
+    fin.close()
+    fout.close()
+
+    missing = getranges(missing)
+    info["missing"] = missing
+    info["missingbytes"] = getbyteranges(missing, sbx.datasize,
+                                         info.get("filesize"))
+    with open(cmdline.patch, "w") as fmiss:
+        json.dump(info, fmiss, indent=2)
+    print("blocks patched: %i" % (patched))
+    if missing:
+        errexit(1, "missing blocks: %i" %
+                sum(last - first + 1 for first, last in missing))
+
+    #all blocks in place, so the hash can be checked
+    if "hash" in info:
+        hashtype, hashdigest = seqbox.decodeMultihash(
+            binascii.unhexlify(info["hash"]))
+        if hashtype:
+            d = hashlib.new(hashtype)
+            readsize = seqbox.getIOConfig(filename)["readsize"]
+            with open(filename, "rb") as fin:
+                for buf in iter(lambda: fin.read(readsize), b""):
+                    d.update(buf)
+            print(seqbox.hashnames[hashtype], d.hexdigest())
+            if d.digest() == hashdigest:
+                print("hash match!")
+            else:
+                errexit(1, "hash mismatch! decoded file corrupted!")
+
+
+def readhashtree(fin, sbxver, password, uid, hashtree):
+    """Read the segments digests from the index blocks & check the root"""
+    sbx = seqbox.SbxBlock(ver=sbxver, pswd=password)
+    index = b""
+    fin.seek(hashtree["firstblock"] * sbx.blocksize, 0)
+    for blocknum in range(hashtree["firstblock"],
+                          hashtree["firstblock"] + hashtree["blocks"]):
+        try:
+            sbx.decode(fin.read(sbx.blocksize))
+        except seqbox.SbxDecodeError:
+            return None
+        if sbx.uid != uid or sbx.blocknum != blocknum:
+            return None
+        index += sbx.data
+    index = index[:hashtree["segcount"] * hashtree["digestlen"]]
+    if hashlib.new(hashtree["hashtype"], index).digest() != hashtree["root"]:
+        return None
+    return [index[p:p+hashtree["digestlen"]]
+            for p in range(0, len(index), hashtree["digestlen"])]
+
+
+def readchunkmap(fin, sbxver, password, uid, chunkmap):
+    """Read the compressed size of every chunk from the index blocks"""
+    sbx = seqbox.SbxBlock(ver=sbxver, pswd=password)
+    index = b""
+    fin.seek(chunkmap["firstblock"] * sbx.blocksize, 0)
+    for blocknum in range(chunkmap["firstblock"],
+                          chunkmap["firstblock"] + chunkmap["blocks"]):
+        try:
+            sbx.decode(fin.read(sbx.blocksize))
+        except seqbox.SbxDecodeError:
+            return None
+        if sbx.uid != uid or sbx.blocknum != blocknum:
+            return None
+        index += sbx.data
+    lengths = [int.from_bytes(index[p:p+4], byteorder='big')
+               for p in range(0, chunkmap["chunks"] * 4, 4)]
+    #the chunks must fill exactly the data blocks
+    if (sum((length + sbx.datasize - 1) // sbx.datasize
+            for length in lengths) != chunkmap["datablocks"]):
+        return None
+    return lengths
+
+
+def decode_chunk(sbxfilename, extent, sbxver, password, uid, codec,
+                 firstblock, length, size, rebuilt=None):
+    """
+    Read the blocks of a compressed chunk at their expected positions (or
+    from the rebuilt ones) and decompress it. Return the data, or None if
+    the chunk is damaged, and the list of the missing blocks.
+    """
+    sbx = seqbox.SbxBlock(ver=sbxver, pswd=password)
+    rebuilt = rebuilt if rebuilt else {}
+    buffer = []
+    missing = []
+    blocks = (length + sbx.datasize - 1) // sbx.datasize
+    with seqbox.openStripes(sbxfilename, extent, "rb") as fin:
+        fin.seek(firstblock * sbx.blocksize, 0)
+        for blocknum in range(firstblock, firstblock + blocks):
+            if blocknum in rebuilt:
+                buffer.append(rebuilt[blocknum])
+                fin.seek(sbx.blocksize, 1)
+                continue
+            try:
+                sbx.decode(fin.read(sbx.blocksize))
+                if sbx.uid != uid or sbx.blocknum != blocknum:
+                    raise seqbox.SbxDecodeError("block out of place")
+            except seqbox.SbxDecodeError:
+                missing.append(blocknum)
+                continue
+            buffer.append(sbx.data)
+    if missing:
+        return None, missing
+    try:
+        data = seqbox.compmodules[codec].decompress(b"".join(buffer)[:length])
+    except (zlib.error, lzma.LZMAError, OSError, ValueError, EOFError):
+        return None, missing
+    if len(data) != size:
+        return None, missing
+    return data, missing
+
+
+def decode_chunks(sbxfilename, extent, sbx, password, metadata, lengths,
+                  chunknums, jobs=1, rebuilt=None):
+    """
+    Decode a list of compressed chunks, in parallel if more than one job is
+    requested, yielding (chunknum, data, missing blocks) in order
+    """
+    chunkmap = seqbox.getChunkMap(metadata, sbx.datasize)
+    chunksize = chunkmap["chunksize"]
+    firstblocks = [1]
+    for length in lengths:
+        firstblocks.append(firstblocks[-1] +
+                           (length + sbx.datasize - 1) // sbx.datasize)
+    executor = ProcessPoolExecutor(max_workers=jobs) if jobs > 1 else None
+    #go in batches, to not keep too many decoded chunks in memory
+    batch = jobs * 4
+    for first in range(0, len(chunknums), batch):
+        batchnums = chunknums[first:first+batch]
+        args = [[sbxfilename] * len(batchnums),
+                [extent] * len(batchnums),
+                [sbx.ver] * len(batchnums),
+                [password] * len(batchnums),
+                [sbx.uid] * len(batchnums),
+                [chunkmap["codec"]] * len(batchnums),
+                [firstblocks[n] for n in batchnums],
+                [lengths[n] for n in batchnums],
+                [min(chunksize, metadata["filesize"] - n * chunksize)
+                 for n in batchnums],
+                [rebuilt] * len(batchnums)]
+        results = executor.map(decode_chunk, *args) if executor else map(
+            decode_chunk, *args)
+        for chunknum, (data, missing) in zip(batchnums, results):
+            yield chunknum, data, missing
+    if executor:
+        executor.shutdown()
+
+
+def decode_segment(sbxfilename, filename, sbxver, password, uid, filesize,
+                   hashtype, digest, firstblock, lastblock, sparse, extent=0,
+                   writesize=0):
+    """
+    Decode and check a segment of the hash tree, reading its blocks at
+    their expected positions. Return the list of the missing blocks and if
+    the digest match.
+    """
+    sbx = seqbox.SbxBlock(ver=sbxver, pswd=password)
+    d = hashlib.new(hashtype)
+    missing = []
+    zeros = bytes(sbx.datasize)
+    fout = (open(filename, "r+b", buffering=writesize or
+                 seqbox.getIOConfig(filename, True)["writesize"])
+            if filename else None)
+    with seqbox.openStripes(sbxfilename, extent, "rb") as fin:
+        fin.seek(firstblock * sbx.blocksize, 0)
+        if fout:
+            fout.seek((firstblock - 1) * sbx.datasize, 0)
+        for blocknum in range(firstblock, lastblock+1):
+            try:
+                sbx.decode(fin.read(sbx.blocksize))
+                if sbx.uid != uid or sbx.blocknum != blocknum:
+                    raise seqbox.SbxDecodeError("block out of place")
+            except seqbox.SbxDecodeError:
+                missing.append(blocknum)
+                if fout:
+                    fout.seek(blocknum * sbx.datasize, 0)
+                continue
+            pos = (blocknum - 1) * sbx.datasize
+            data = sbx.data[:max(0, filesize - pos)]
+            d.update(data)
+            if fout:
+                if sparse and data == zeros[:len(data)]:
+                    fout.seek(len(data), 1)
+                else:
+                    fout.write(data)
+    if fout:
+        fout.close()
+    return missing, d.digest() == digest
+
+
+def rebuild(fin, sbxver, password, uid, parity, missing):
+    """
+    Rebuild the missing data blocks using the parity blocks, reading the
+    groups at their expected positions. Return a dict blocknum:payload.
+    """
+    sbx = seqbox.SbxBlock(ver=sbxver, pswd=password)
+    k, m = parity["k"], parity["m"]
+    codec = seqbox.RSCodec(k, m)
+    rebuilt = {}
+    for groupnum in sorted(set((blocknum - 1) // k for blocknum in missing
+                               if blocknum <= parity["datablocks"])):
+        firstblock = groupnum * k + 1
+        count = min(k, parity["datablocks"] - firstblock + 1)
+        blocknums = [firstblock + i for i in range(count)] + [
+            None] * (k - count) + [parity["firstblock"] + groupnum * m + j
+                                   for j in range(m)]
+        blocks = {}
+        for idx, blocknum in enumerate(blocknums):
+            if blocknum is None or blocknum in missing:
+                continue
+            fin.seek(blocknum * sbx.blocksize, 0)
+            try:
+                sbx.decode(fin.read(sbx.blocksize))
+            except seqbox.SbxDecodeError:
+                continue
+            if sbx.uid == uid and sbx.blocknum == blocknum:
+                blocks[idx] = sbx.data
+        res = codec.decode(blocks, count, sbx.datasize)
+        if res:
+            for idx, data in res.items():
+                rebuilt[firstblock + idx] = data
+    return rebuilt
+
+
+def readpayloads(fin, sbx, datablocks, filesize, rebuilt):
+    """Read all the data payloads in order, from their expected positions"""
+    for blocknum in range(1, datablocks + 1):
+        if blocknum in rebuilt:
+            yield rebuilt[blocknum]
+            continue
+        fin.seek(blocknum * sbx.blocksize, 0)
+        try:
+            sbx.decode(fin.read(sbx.blocksize))
+        except seqbox.SbxDecodeError:
+            sbx.data = b""
+        pos = (blocknum - 1) * sbx.datasize
+        yield sbx.data[:max(0, filesize - pos)]
+
+
+def rehash(payloads, hashtype, hashtree, segments):
+    """
+    Hash again the whole data, after some blocks were rebuilt. Return the
+    hash object (if any) and the list of the bad segments of the hash tree.
+    """
+    d = hashlib.new(hashtype) if hashtype else None
+    badsegments = []
+    segd = None
+    for blocknum, data in enumerate(payloads, 1):
+        if d:
+            d.update(data)
+        if segments:
+            if (blocknum - 1) % hashtree["segblocks"] == 0:
+                segd = hashlib.new(hashtree["hashtype"])
+            segd.update(data)
+            if (blocknum % hashtree["segblocks"] == 0 or
+                blocknum == hashtree["firstblock"] - 1):
+                segnum = (blocknum - 1) // hashtree["segblocks"]
+                if segd.digest() != segments[segnum]:
+                    badsegments.append(segnum)
+    return d, badsegments
+
+
 def main():
 
     cmdline = get_cmdline()
+    if cmdline.patch:
+        patch(cmdline)
+        return
 
     sbxfilename = cmdline.sbxfilename
     filename = cmdline.filename
@@ -88,9 +527,19 @@ def main():
     if not os.path.exists(sbxfilename):
         errexit(1, "sbx file '%s' not found" % (sbxfilename))
     sbxfilesize = os.path.getsize(sbxfilename)
+    #read all the members of a stripe set as a single file
+    sbxfilenames = sbxfilename
+    extent = 0
+    if cmdline.stripe:
+        sbxfilenames, extent = getstripes([sbxfilename] + cmdline.stripe,
+                                          cmdline.password)
+        sbxfilename = sbxfilenames[0]
+        sbxfilesize = sum(os.path.getsize(name) for name in sbxfilenames)
 
     print("decoding '%s'..." % (sbxfilename))
-    fin = open(sbxfilename, "rb", buffering=1024*1024)
+    fin = seqbox.openStripes(
+        sbxfilenames, extent, "rb",
+        buffering=seqbox.getIOConfig(sbxfilename)["readsize"])
 
     #check magic and get version
     header = fin.read(4)
@@ -98,18 +547,26 @@ def main():
     if cmdline.password:
         e = seqbox.EncDec(cmdline.password, len(header))
         header= e.xor(header)
-    if header[:3] != b"SBx":
-        errexit(1, "not a SeqBox file!")
-    sbxver = header[3]
+    if header[:3] == b"SBx" and header[3] in seqbox.supported_vers:
+        sbxver = header[3]
+    else:
+        #the first block could be just damaged
+        sbx, index = firstvalidblock(sbxfilename, cmdline.password)
+        if sbx is None:
+            errexit(1, "not a SeqBox file!")
+        sbxver = sbx.ver
     
     sbx = seqbox.SbxBlock(ver=sbxver, pswd=cmdline.password)
     metadata = {}
     trimfilesize = False
 
-    hashtype = 0
-    hashlen = 0
+    hashtype = None
     hashdigest = b""
     hashcheck = False
+    hashtree = None
+    segments = None
+    chunkmap = None
+    lengths = None
 
     buffer = fin.read(sbx.blocksize)
 
@@ -128,11 +585,28 @@ def main():
         if "filesize" in metadata:
             trimfilesize = True
         if "hash" in metadata:
-            hashtype = metadata["hash"][0]
-            if hashtype == 0x12:
-                hashlen = metadata["hash"][1]
-                hashdigest = metadata["hash"][2:2+hashlen]
+            hashtype, hashdigest = seqbox.decodeMultihash(metadata["hash"])
+            if hashtype:
                 hashcheck = True
+        hashtree = seqbox.getHashTree(metadata, sbx.datasize)
+        #with parity blocks, missing blocks can be rebuilt at the end
+        if seqbox.getParity(metadata, sbx.datasize):
+            cmdline.cont = True
+        if hashtree:
+            segments = readhashtree(fin, sbx.ver, cmdline.password, sbx.uid,
+                                    hashtree)
+            fin.seek(sbx.blocksize, 0)
+            if segments:
+                print("hash tree found!")
+            else:
+                print("hash tree damaged!")
+        chunkmap = seqbox.getChunkMap(metadata, sbx.datasize)
+        if chunkmap:
+            lengths = readchunkmap(fin, sbx.ver, cmdline.password, sbx.uid,
+                                   chunkmap)
+            fin.seek(sbx.blocksize, 0)
+            if lengths is None and not cmdline.info:
+                errexit(1, "compressed chunks map damaged!")
         
     else:
         #first block is data, so reset from the start
@@ -163,11 +637,21 @@ def main():
                       (time.strftime("%Y-%m-%d %H:%M:%S",
                                      time.localtime(metadata["filedatetime"]))))
             if "hash" in metadata:
-                if hashtype == 0x12:
-                    print("  SHA256: %s" % (binascii.hexlify(
-                        hashdigest).decode()))
+                if hashtype:
+                    print("  %s: %s" % (seqbox.hashnames[hashtype],
+                                        binascii.hexlify(hashdigest).decode()))
                 else:
                     print("  hash type not recognized!")
+            if hashtree:
+                print("  hash tree: %i segment(s) of %i blocks - root %s" %
+                      (hashtree["segcount"], hashtree["segblocks"],
+                       binascii.hexlify(hashtree["root"]).decode()
+                       if segments else "damaged!"))
+            if chunkmap:
+                print("  compression: %s - %i chunk(s) of %i bytes%s" %
+                      (chunkmap["codec"], chunkmap["chunks"],
+                       chunkmap["chunksize"],
+                       "" if lengths is not None else " - map damaged!"))
         sys.exit(0)
 
     #evaluate target filename
@@ -187,75 +671,265 @@ def main():
         if os.path.exists(filename) and not cmdline.overwrite:
             errexit(1, "target file '%s' already exists!" % (filename)) 
         print("creating file '%s'..." % (filename))
-        fout= open(filename, "wb", buffering=1024*1024)
+        fout= open(filename, "wb",
+                   buffering=seqbox.getIOConfig(filename, True)["writesize"])
 
-    if hashtype == 0x12:
-        d = hashlib.sha256()
+    if hashcheck:
+        d = hashlib.new(hashtype)
     lastblocknum = 0
 
-    filesize = 0
-    blockmiss = 0
+    #every block is written at its own position, so missing blocks just
+    #leave a gap that can be patched later
+    outpos = 0
+    maxpos = 0
+    missing = set()
+    badsegments = []
+    zeros = bytes(sbx.datasize)
     updatetime = time.time() 
-    while True:
-        buffer = fin.read(sbx.blocksize)
-        if len(buffer) < sbx.blocksize:
-            break
+    badchunks = []
+    if chunkmap:
+        #every chunk is compressed on its own, so they can be decoded in
+        #parallel, and then written & hashed in order
+        for chunknum, data, chunkmissing in decode_chunks(
+                sbxfilenames, extent, sbx, cmdline.password, metadata,
+                lengths, list(range(chunkmap["chunks"])), cmdline.jobs):
+            missing.update(chunkmissing)
+            if data is None:
+                badchunks.append(chunknum)
+            else:
+                #the hash is checked again later if some chunks are bad
+                if hashcheck and not badchunks:
+                    d.update(data)
+                if not cmdline.test:
+                    fout.seek(chunknum * chunkmap["chunksize"], 0)
+                    if cmdline.sparse and data == bytes(len(data)):
+                        fout.seek(len(data), 1)
+                    else:
+                        fout.write(data)
+            if time.time() > updatetime:
+                print("  %.1f%%" % (chunknum*100.0/chunkmap["chunks"]),
+                      end="\r", flush=True)
+                updatetime = time.time() + .1
+        lastblocknum = chunkmap["datablocks"]
+        if not cmdline.test:
+            fout.truncate(metadata["filesize"])
+            fout.close()
+
+    elif segments and cmdline.jobs > 1:
+        #decode & check all the segments of the hash tree in parallel
+        writesize = 0
+        if not cmdline.test:
+            fout.truncate(metadata["filesize"])
+            fout.close()
+            #already probed: the workers just use it
+            writesize = seqbox.getIOConfig(filename, True)["writesize"]
+        with ProcessPoolExecutor(max_workers=cmdline.jobs) as executor:
+            tasks = {}
+            for segnum, digest in enumerate(segments):
+                firstblock = segnum * hashtree["segblocks"] + 1
+                lastblock = min(firstblock + hashtree["segblocks"] - 1,
+                                hashtree["firstblock"] - 1)
+                tasks[executor.submit(decode_segment, sbxfilenames,
+                                      None if cmdline.test else filename,
+                                      sbx.ver, cmdline.password, sbx.uid,
+                                      metadata["filesize"],
+                                      hashtree["hashtype"], digest,
+                                      firstblock, lastblock,
+                                      cmdline.sparse, extent,
+                                      writesize)] = segnum
+            for segcount, task in enumerate(as_completed(tasks)):
+                segmissing, segok = task.result()
+                missing.update(segmissing)
+                if not segok:
+                    badsegments.append(tasks[task])
+                if time.time() > updatetime: 
+                    print("  %.1f%%" % (segcount*100.0/len(tasks)),
+                          end="\r", flush=True)
+                    updatetime = time.time() + .1
+        #the whole file hash is replaced by the root & the segments digests
+        hashcheck = False
+        lastblocknum = hashtree["firstblock"] - 1
+        if missing and not cmdline.cont:
+            print("blocks out of order or missing - try with -j 1")
 
-        try:
-            sbx.decode(buffer)
-            if sbx.blocknum > lastblocknum+1:
+    else:
+        cursegnum = -1
+        while True:
+            buffer = fin.read(sbx.blocksize)
+            #some progress report, for every block (0 too) and at the end
+            if time.time() > updatetime or len(buffer) < sbx.blocksize:
+                print("  %.1f%%" % (fin.tell()*100.0/sbxfilesize),
+                      end="\r", flush=True)
+                updatetime = time.time() + .1
+            if len(buffer) < sbx.blocksize:
+                break
+
+            try:
+                sbx.decode(buffer)
+                if sbx.blocknum > lastblocknum+1:
+                    if cmdline.cont:
+                        missing.update(range(lastblocknum+1, sbx.blocknum))
+                    else:
+                        errexit(errlev=1,
+                                mess="block %i out of order or missing"
+                                % (lastblocknum+1))    
+                if sbx.blocknum == 0:
+                    continue
+                missing.discard(sbx.blocknum)
+                lastblocknum = max(lastblocknum, sbx.blocknum)
+                pos = (sbx.blocknum - 1) * sbx.datasize
+                if trimfilesize:
+                    sbx.data = sbx.data[:max(0, metadata["filesize"] - pos)]
+                if hashcheck:
+                    d.update(sbx.data) 
+                #check every segment of the hash tree, to localize errors
+                if segments and sbx.blocknum < hashtree["firstblock"]:
+                    segnum = (sbx.blocknum - 1) // hashtree["segblocks"]
+                    if segnum != cursegnum:
+                        if (cursegnum >= 0 and
+                            segd.digest() != segments[cursegnum]):
+                            badsegments.append(cursegnum)
+                        cursegnum = segnum
+                        segd = hashlib.new(hashtree["hashtype"])
+                    segd.update(sbx.data)
+                if not cmdline.test and len(sbx.data):
+                    if pos != outpos:
+                        fout.seek(pos, 0)
+                    if cmdline.sparse and sbx.data == zeros[:len(sbx.data)]:
+                        fout.seek(len(sbx.data), 1)
+                    else:
+                        fout.write(sbx.data)
+                    outpos = pos + len(sbx.data)
+                    maxpos = max(maxpos, outpos)
+
+            except seqbox.SbxDecodeError as err:
                 if cmdline.cont:
-                    blockmiss += 1
                     lastblocknum += 1
+                    missing.add(lastblocknum)
                 else:
-                    errexit(errlev=1, mess="block %i out of order or missing"
-                             % (lastblocknum+1))    
-            lastblocknum += 1
-            if trimfilesize:
-                filesize += sbx.datasize
-                if filesize > metadata["filesize"]:
-                    sbx.data = sbx.data[:-(filesize - metadata["filesize"])]
-            if hashcheck:
-                d.update(sbx.data) 
-            if not cmdline.test:
-                fout.write(sbx.data)
-
-        except seqbox.SbxDecodeError as err:
-            if cmdline.cont:
-                blockmiss += 1
-                lastblocknum += 1
+                    print(err)
+                    errexit(errlev=1, mess="invalid block at offset %s" %
+                            (hex(fin.tell()-sbx.blocksize)))
+
+        if cursegnum >= 0 and segd.digest() != segments[cursegnum]:
+            badsegments.append(cursegnum)
+
+        if not cmdline.test:
+            #set the size in case the file end with a hole or missing blocks
+            fout.truncate(metadata["filesize"] if trimfilesize else maxpos)
+            fout.close()
+
+    #blocks missing at the end
+    if trimfilesize:
+        datablocks = seqbox.getDataBlocks(metadata, sbx.datasize)
+        missing.update(range(lastblocknum+1, datablocks+1))
+
+    #rebuild what's possible using the parity blocks
+    parity = seqbox.getParity(metadata, sbx.datasize)
+    if parity and missing:
+        #lost parity blocks are not lost data
+        missing = {blocknum for blocknum in missing
+                   if blocknum < parity["firstblock"]}
+        rebuilt = rebuild(fin, sbx.ver, cmdline.password, sbx.uid, parity,
+                          missing)
+        if rebuilt:
+            print("blocks rebuilt using parity: %i" % (len(rebuilt)))
+            missing.difference_update(rebuilt)
+            if chunkmap:
+                #the rebuilt blocks hold compressed data, so the chunks
+                #they belong to must be decoded again
+                chunknums, badchunks = badchunks, []
+                if not cmdline.test:
+                    fout = open(filename, "r+b")
+                for chunknum, data, chunkmissing in decode_chunks(
+                        sbxfilenames, extent, sbx, cmdline.password, metadata,
+                        lengths, chunknums, cmdline.jobs, rebuilt):
+                    if data is None:
+                        badchunks.append(chunknum)
+                    elif not cmdline.test:
+                        fout.seek(chunknum * chunkmap["chunksize"], 0)
+                        fout.write(data)
+                if not cmdline.test:
+                    fout.close()
             else:
-                print(err)
-                errexit(errlev=1, mess="invalid block at offset %s" %
-                        (hex(fin.tell()-sbx.blocksize)))
-
-        #some progress report
-        if time.time() > updatetime: 
-            print("  %.1f%%" % (fin.tell()*100.0/sbxfilesize),
-                  end="\r", flush=True)
-            updatetime = time.time() + .1
+                for blocknum in rebuilt:
+                    pos = (blocknum - 1) * sbx.datasize
+                    rebuilt[blocknum] = rebuilt[blocknum][
+                        :max(0, metadata["filesize"] - pos)]
+                if not cmdline.test:
+                    with open(filename, "r+b") as fout:
+                        for blocknum, data in rebuilt.items():
+                            fout.seek((blocknum - 1) * sbx.datasize, 0)
+                            fout.write(data)
+            #if nothing is missing anymore, check the hash again
+            if not missing and not badchunks and (hashcheck or segments):
+                if chunkmap and cmdline.test:
+                    payloads = (data for chunknum, data, chunkmissing in
+                                decode_chunks(sbxfilenames, extent, sbx,
+                                              cmdline.password, metadata,
+                                              lengths,
+                                              list(range(chunkmap["chunks"])),
+                                              cmdline.jobs, rebuilt))
+                elif cmdline.test:
+                    payloads = readpayloads(fin, sbx, datablocks,
+                                            metadata["filesize"], rebuilt)
+                else:
+                    fout = open(filename, "rb", buffering=seqbox.getIOConfig(
+                        filename)["readsize"])
+                    payloads = iter(lambda: fout.read(sbx.datasize), b"")
+                d, badsegments = rehash(payloads,
+                                        hashtype if hashcheck else None,
+                                        hashtree, segments)
+                if not cmdline.test:
+                    fout.close()
 
     fin.close()
     if not cmdline.test:
-        fout.close()
         if metadata:
             if "filedatetime" in metadata:
                 os.utime(filename,
                          (int(time.time()), metadata["filedatetime"]))
 
+    missing = getranges(sorted(missing))
+    if cmdline.missing:
+        savemissing(cmdline.missing, sbx, metadata, filename, missing)
+
     print("SBX decoding complete")
-    if blockmiss:
-        errexit(1, "missing blocks: %i" % blockmiss)
+    badsegments.sort()
+    for segnum in badsegments[:10]:
+        firstblock = segnum * hashtree["segblocks"] + 1
+        print("  bad segment %i: blocks %i-%i" %
+              (segnum, firstblock, min(firstblock + hashtree["segblocks"] - 1,
+                                       hashtree["firstblock"] - 1)))
+    if len(badsegments) > 10:
+        print("  ...")
+    if missing:
+        for (first, last), (start, end) in zip(
+                missing[:10], getbyteranges(missing[:10], sbx.datasize,
+                                            metadata.get("filesize"))):
+            print("  missing blocks: %i-%i (bytes %i-%i)" %
+                  (first, last, start, end-1))
+        if len(missing) > 10:
+            print("  ...")
+        errexit(1, "missing blocks: %i" %
+                sum(last - first + 1 for first, last in missing))
+    if badchunks:
+        errexit(1, "%i compressed chunk(s) damaged! decoded file corrupted!"
+                % len(badchunks))
+    if badsegments:
+        errexit(1, "hash tree mismatch in %i segment(s)! decoded file corrupted!"
+                % len(badsegments))
+    if segments:
+        print("hash tree match!")
 
     if hashcheck:
-        if hashtype == 0x12:
-            print("SHA256", d.hexdigest())
+        print(seqbox.hashnames[hashtype], d.hexdigest())
 
         if d.digest() == hashdigest:
             print("hash match!")
         else:
             errexit(1, "hash mismatch! decoded file corrupted!")
-    else:
+    elif not segments:
         print("can't check integrity via hash!")
         #if filesize unknown, estimate based on 0x1a padding at block's end
         if not trimfilesize:
@@ -25,10 +25,17 @@
 
 import os
 import sys
+import glob
+import json
+import queue
 import hashlib
 import argparse
 import binascii
-from functools import partial
+import tempfile
+import threading
+import contextlib
+from itertools import repeat
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from time import time
 
 import seqbox
@@ -40,14 +47,26 @@ def get_cmdline():
     parser = argparse.ArgumentParser(
              description="create a SeqBox container",
              formatter_class=argparse.ArgumentDefaultsHelpFormatter,
-             prefix_chars='-+')
+             prefix_chars='-+', fromfile_prefix_chars='@')
     parser.add_argument("-v", "--version", action='version', 
                         version='SeqBox - Sequenced Box container - ' +
                         'Encoder v%s - (C) 2017 by M.Pontello' % PROGRAM_VER) 
-    parser.add_argument("filename", action="store", 
-                        help="file to encode")
-    parser.add_argument("sbxfilename", action="store", nargs='?',
-                        help="SBX container")
+    parser.add_argument("filename", action="store", nargs="+",
+                        help=("file to encode and optional SBX container, " +
+                              "or file(s)/dir(s)/mask(s) to encode with -d"))
+    parser.add_argument("-d", "--destpath", action="store", metavar="path",
+                        help="bulk mode: encode all files to this path")
+    parser.add_argument("-r", "--recurse", action="store_true", default=False,
+                        help="bulk mode: recurse into directories")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(),
+                        help="worker processes (bulk mode & compression)",
+                        metavar="n")
+    parser.add_argument("-sp", "--split", type=int, default=64,
+                        help="bulk mode: split files in chunks of MB",
+                        metavar="n")
+    parser.add_argument("-m", "--manifest", action="store", metavar="filename",
+                        help="bulk mode: JSON manifest",
+                        default="sbxenc.json")
     parser.add_argument("-o", "--overwrite", action="store_true", default=False,
                         help="overwrite existing file")
     parser.add_argument("-nm","--nometa", action="store_true", default=False,
@@ -58,6 +77,30 @@ def get_cmdline():
                         help="SBX blocks version", metavar="n")
     parser.add_argument("-p", "--password", type=str, default="",
                         help="encrypt with password", metavar="pass")
+    parser.add_argument("-ha", "--hash", action="store", default="sha256",
+                        choices=sorted(seqbox.hashcodes) + ["none"],
+                        help="crypto hash stored in the metadata")
+    parser.add_argument("-ht", "--hashtree", type=int, default=0,
+                        help="add a hash tree with segments of MB (0=no)",
+                        metavar="n")
+    parser.add_argument("-pa", "--parity", action="store", metavar="k,m",
+                        help=("add m Reed-Solomon parity blocks every k " +
+                              "data blocks"))
+    parser.add_argument("-st", "--stripe", action="store", nargs="+",
+                        metavar="filename", default=[],
+                        help=("stripe the SBX container across these " +
+                              "files too"))
+    parser.add_argument("-ss", "--stripesize", type=int, default=1024,
+                        help="stripe extent size in KB", metavar="n")
+    parser.add_argument("-c", "--compress", action="store",
+                        choices=sorted(seqbox.compcodes),
+                        help="compress the data in independent chunks")
+    parser.add_argument("-cs", "--chunksize", type=int, default=1024,
+                        help="compression chunks size in KB", metavar="n")
+    parser.add_argument("-rp", "--replica", action="append", default=[],
+                        metavar="path",
+                        help="write a copy of the SBX container here too " +
+                             "(can be repeated)")
     res = parser.parse_args()
     return res
 
@@ -70,29 +113,605 @@ def errexit(errlev=1, mess=""):
     sys.exit(errlev)
     
 
-def getsha256(filename):
-    """SHA256 used to verify the integrity of the encoded file"""
+def gethash(filename, hashtype="sha256", segsize=0, readsize=0):
+    """
+    Crypto hash used to verify the integrity of the encoded file, plus the
+    list of the digests of every segment of segsize bytes, if requested
+    """
+    filesize = os.path.getsize(filename)
+    readsize = readsize or seqbox.getIOConfig(filename)["readsize"]
+    zeros = bytes(readsize)
+    segments = []
+    seg = {"d":hashlib.new(hashtype), "left":segsize}
+
+    def update(buf):
+        d.update(buf)
+        if segsize:
+            buf = memoryview(buf)
+            while len(buf):
+                seg["d"].update(buf[:seg["left"]])
+                if seg["left"] > len(buf):
+                    seg["left"] -= len(buf)
+                    break
+                buf = buf[seg["left"]:]
+                segments.append(seg["d"].digest())
+                seg["d"] = hashlib.new(hashtype)
+                seg["left"] = segsize
+
     with open(filename, mode='rb') as fin:
-        d = hashlib.sha256()
-        for buf in iter(partial(fin.read, 1024*1024), b''):
-            d.update(buf)
-    return d.digest()
+        d = hashlib.new(hashtype)
+        pos = 0
+        #holes of sparse files are hashed as zeros, without reading them
+        for start, end in seqbox.getDataExtents(filename, filesize) + \
+                          [(filesize, filesize)]:
+            while pos < start:
+                update(zeros[:min(len(zeros), start - pos)])
+                pos += min(len(zeros), start - pos)
+            fin.seek(start, 0)
+            while pos < end:
+                buf = fin.read(min(readsize, end - pos))
+                if len(buf) == 0:
+                    break
+                update(buf)
+                pos += len(buf)
+    if segsize and seg["left"] < segsize:
+        segments.append(seg["d"].digest())
+    return d.digest(), segments
+
+
+class ReplicaWriter():
+    """
+    Fan out the writes to many files, each with its own writer thread, so
+    they all proceed at the speed of their own media. A destination that
+    fails is dropped, while the others go on.
+    """
+
+    def __init__(self, fouts, names, chunksize=1024*1024, queuesize=16):
+        self.pos = 0
+        self.buf = bytearray()
+        self.bufpos = 0
+        self.chunksize = chunksize
+        self.dests = []
+        for fout, name in zip(fouts, names):
+            dest = {"name":name, "fout":fout, "queue":queue.Queue(queuesize),
+                    "bytes":0, "starttime":None, "endtime":None,
+                    "error":None}
+            dest["thread"] = threading.Thread(target=self.writer, args=(dest,),
+                                              daemon=True)
+            dest["thread"].start()
+            self.dests.append(dest)
+
+    def writer(self, dest):
+        while True:
+            chunk = dest["queue"].get()
+            if chunk is None:
+                break
+            if dest["error"]:
+                continue
+            pos, data = chunk
+            if dest["starttime"] is None:
+                dest["starttime"] = time()
+            try:
+                dest["fout"].seek(pos, 0)
+                dest["fout"].write(data)
+                dest["bytes"] += len(data)
+            except OSError as err:
+                dest["error"] = str(err)
+        try:
+            dest["fout"].close()
+        except OSError as err:
+            dest["error"] = dest["error"] or str(err)
+        dest["endtime"] = time()
+        if dest["starttime"] is None:
+            dest["starttime"] = dest["endtime"]
+
+    def flush(self):
+        """Send the pending chunk to all the writers"""
+        if self.buf:
+            chunk = (self.bufpos, bytes(self.buf))
+            for dest in self.dests:
+                dest["queue"].put(chunk)
+            self.buf = bytearray()
+
+    def write(self, data):
+        #join contiguous writes in bigger chunks
+        if self.pos != self.bufpos + len(self.buf):
+            self.flush()
+        if not self.buf:
+            self.bufpos = self.pos
+        self.buf += data
+        self.pos += len(data)
+        if len(self.buf) >= self.chunksize:
+            self.flush()
+        return len(data)
+
+    def seek(self, pos, whence=0):
+        if whence == 1:
+            pos += self.pos
+        self.pos = pos
+        return pos
+
+    def tell(self):
+        return self.pos
+
+    def close(self):
+        self.flush()
+        for dest in self.dests:
+            dest["queue"].put(None)
+        for dest in self.dests:
+            dest["thread"].join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def report(self):
+        """Bytes written, throughput & error of every destination"""
+        return [(dest["name"], dest["bytes"],
+                 dest["bytes"] / max(dest["endtime"] - dest["starttime"],
+                                     0.001),
+                 dest["error"]) for dest in self.dests]
+
+
+def opensbx(sbxfilename, extent=0, fout=None, writesize=0):
+    """Open the SBX file to write, unless an already open one is given"""
+    if fout:
+        return contextlib.nullcontext(fout)
+    name = sbxfilename if isinstance(sbxfilename, str) else sbxfilename[0]
+    return seqbox.openStripes(
+        sbxfilename, extent, "r+b",
+        buffering=writesize or seqbox.getIOConfig(name,
+                                                  write=True)["writesize"])
+
+
+def blockpos(blocknum, blocksize, nometa):
+    """Offset of a block in the SBX file"""
+    return (blocknum - 1 if nometa else blocknum) * blocksize
+
+
+def encode_meta(sbxfilename, sbxver, uid, password, metadata, filename,
+                hashtype, extent=0, fout=None, readsize=0, writesize=0):
+    """
+    Hash the file and write the metadata block 0, plus the index blocks
+    of the hash tree if the metadata ask for one
+    """
+    sbx = seqbox.SbxBlock(uid=uid, ver=sbxver, pswd=password)
+    sbx.metadata = dict(metadata)
+    digest = b""
+    segments = []
+    if hashtype != "none":
+        #calc hash - before all processing, and not while reading the file,
+        #just to be cautious
+        segsize = sbx.metadata.get("hashtreeseg", 0) * sbx.datasize
+        digest, segments = gethash(filename, hashtype, segsize, readsize)
+        sbx.metadata["hash"] = seqbox.encodeMultihash(hashtype, digest)
+        if segsize:
+            root = hashlib.new(hashtype, b"".join(segments)).digest()
+            sbx.metadata["hashtreeroot"] = seqbox.encodeMultihash(hashtype,
+                                                                  root)
+    with opensbx(sbxfilename, extent, fout, writesize) as fout:
+        fout.seek(0, 0)
+        fout.write(sbx.encode())
+        hashtree = seqbox.getHashTree(sbx.metadata, sbx.datasize)
+        if hashtree:
+            index = b"".join(segments)
+            fout.seek(hashtree["firstblock"] * sbx.blocksize, 0)
+            for p in range(0, len(index), sbx.datasize):
+                sbx.blocknum = hashtree["firstblock"] + p // sbx.datasize
+                sbx.data = index[p:p+sbx.datasize]
+                fout.write(sbx.encode())
+    return digest
+
+
+def encode_parity(fout, sbx, parity, codec, groupnum, payloads):
+    """Write the parity blocks of a group, going back to the data after"""
+    pos = fout.tell()
+    blocknum = parity["firstblock"] + groupnum * parity["m"]
+    fout.seek(blockpos(blocknum, sbx.blocksize, False), 0)
+    for data in codec.encode(payloads):
+        sbx.blocknum = blocknum
+        sbx.data = data
+        fout.write(sbx.encode())
+        blocknum += 1
+    fout.seek(pos, 0)
+
+
+def encode_blocks(filename, sbxfilename, sbxver, uid, password, nometa,
+                  firstblock, lastblock, progress=False, parity=None,
+                  extent=0, fout=None, readsize=0, writesize=0):
+    """
+    Encode a range of data blocks, writing them at their position, plus
+    the parity blocks of their groups (the range must start at a group
+    boundary). The SBX file can be a list of files to stripe across.
+    The I/O sizes are tuned for the devices, if not given.
+    """
+    sbx = seqbox.SbxBlock(uid=uid, ver=sbxver, pswd=password)
+    if parity:
+        codec = seqbox.RSCodec(parity["k"], parity["m"])
+        payloads = []
+    filesize = os.path.getsize(filename)
+    extents = seqbox.getDataExtents(filename, filesize)
+    zeros = bytes(sbx.datasize)
+    ext = 0
+    with open(filename, "rb", buffering=readsize or
+              seqbox.getIOConfig(filename)["readsize"]) as fin, \
+         opensbx(sbxfilename, extent, fout, writesize) as fout:
+        fin.seek((firstblock-1) * sbx.datasize, 0)
+        fout.seek(blockpos(firstblock, sbx.blocksize, nometa), 0)
+        updatetime = time()
+        for blocknum in range(firstblock, lastblock+1):
+            sbx.blocknum = blocknum
+            start = (blocknum-1) * sbx.datasize
+            end = min(start + sbx.datasize, filesize)
+            while ext < len(extents) and extents[ext][1] <= start:
+                ext += 1
+            if ext == len(extents) or extents[ext][0] >= end:
+                #block entirely in a hole: no need to read it
+                sbx.data = zeros[:end - start]
+                fin.seek(end, 0)
+            else:
+                sbx.data = fin.read(sbx.datasize)
+            fout.write(sbx.encode())
+
+            if parity:
+                payloads.append(sbx.data +
+                                b'\x1a' * (sbx.datasize - len(sbx.data)))
+                if (len(payloads) == parity["k"] or
+                    blocknum == parity["datablocks"]):
+                    encode_parity(fout, sbx, parity, codec,
+                                  (blocknum - 1) // parity["k"], payloads)
+                    payloads = []
+
+            #some progress update
+            if progress and time() > updatetime:
+                print("%.1f%%" % (blocknum*100.0/lastblock), " ",
+                      end="\r", flush=True)
+                updatetime = time() + .1
+    return lastblock - firstblock + 1
+
+
+def compress_chunk(filename, codec, pos, size):
+    """Read & compress a chunk of the file"""
+    with open(filename, "rb") as fin:
+        fin.seek(pos, 0)
+        return seqbox.compmodules[codec].compress(fin.read(size))
+
+
+def encode_compressed(filename, sbxfilename, sbxver, uid, password, metadata,
+                      jobs, extent=0, fout=None):
+    """
+    Compress the file in independent chunks, in parallel, and write them
+    as data blocks, every chunk starting on a new block. Then write the
+    map of the chunks and the parity blocks, and set the number of data
+    blocks in the metadata.
+    """
+    sbx = seqbox.SbxBlock(uid=uid, ver=sbxver, pswd=password)
+    codec, chunksize, datablocks = metadata["compress"]
+    filesize = metadata["filesize"]
+    chunks = (filesize + chunksize - 1) // chunksize
+    lengths = []
+    if "parity" in metadata:
+        k, m = metadata["parity"]
+        rscodec = seqbox.RSCodec(k, m)
+        payloads = []
+        #the parity payloads wait here until their position is known
+        spool = tempfile.TemporaryFile()
+    blocknum = 1
+    updatetime = time()
+    with opensbx(sbxfilename, extent, fout) as fout, \
+         ProcessPoolExecutor(max_workers=jobs) as executor:
+        fout.seek(blockpos(1, sbx.blocksize, False), 0)
+        batch = jobs * 4
+        for firstchunk in range(0, chunks, batch):
+            positions = range(firstchunk * chunksize,
+                              min(chunks, firstchunk + batch) * chunksize,
+                              chunksize)
+            for data in executor.map(compress_chunk, repeat(filename),
+                                     repeat(codec), positions,
+                                     repeat(chunksize)):
+                lengths.append(len(data))
+                for p in range(0, len(data), sbx.datasize):
+                    sbx.blocknum = blocknum
+                    sbx.data = data[p:p+sbx.datasize]
+                    fout.write(sbx.encode())
+                    blocknum += 1
+                    if "parity" in metadata:
+                        payloads.append(sbx.data + b'\x1a' *
+                                        (sbx.datasize - len(sbx.data)))
+                        if len(payloads) == k:
+                            spool.write(b"".join(rscodec.encode(payloads)))
+                            payloads = []
+
+            #some progress update
+            if time() > updatetime:
+                print("%.1f%%" % (len(lengths)*100.0/chunks), " ",
+                      end="\r", flush=True)
+                updatetime = time() + .1
+
+        metadata["compress"] = (codec, chunksize, blocknum - 1)
+
+        #the compressed size of every chunk
+        chunkmap = seqbox.getChunkMap(metadata, sbx.datasize)
+        index = b"".join(length.to_bytes(4, byteorder='big')
+                         for length in lengths)
+        fout.seek(blockpos(chunkmap["firstblock"], sbx.blocksize, False), 0)
+        for p in range(0, len(index), sbx.datasize):
+            sbx.blocknum = chunkmap["firstblock"] + p // sbx.datasize
+            sbx.data = index[p:p+sbx.datasize]
+            fout.write(sbx.encode())
+
+        parity = seqbox.getParity(metadata, sbx.datasize)
+        if parity:
+            if payloads:
+                spool.write(b"".join(rscodec.encode(payloads)))
+            spool.seek(0, 0)
+            fout.seek(blockpos(parity["firstblock"], sbx.blocksize, False), 0)
+            for blocknum in range(parity["firstblock"],
+                                  parity["firstblock"] + parity["blocks"]):
+                sbx.blocknum = blocknum
+                sbx.data = spool.read(sbx.datasize)
+                fout.write(sbx.encode())
+            spool.close()
+    return metadata["compress"][2]
+
+
+def encode_file(filename, sbxfilename, sbxver, uid, password, nometa,
+                metadata, hashtype, blocks, parity, readsize=0, writesize=0):
+    """Encode a whole file - metadata included - in a single worker"""
+    digest = b""
+    if not nometa:
+        digest = encode_meta(sbxfilename, sbxver, uid, password, metadata,
+                             filename, hashtype, readsize=readsize,
+                             writesize=writesize)
+    encode_blocks(filename, sbxfilename, sbxver, uid, password, nometa,
+                  1, blocks, parity=parity, readsize=readsize,
+                  writesize=writesize)
+    return digest
+
+
+def setlayoutmeta(cmdline, sbx, metadata):
+    """
+    Add to the metadata the hash tree and parity parameters, if requested.
+    The hash tree root is just a placeholder until the file is hashed, but
+    with the right size to already know where the parity blocks go.
+    """
+    if cmdline.hashtree:
+        if cmdline.nometa or cmdline.hash == "none":
+            errexit(1, "hash tree require metadata and a hash")
+        metadata["hashtreeseg"] = max(1, cmdline.hashtree*1024*1024 //
+                                      sbx.datasize)
+        metadata["hashtreeroot"] = seqbox.encodeMultihash(
+            cmdline.hash, bytes(hashlib.new(cmdline.hash).digest_size))
+    if cmdline.compress:
+        if cmdline.nometa:
+            errexit(1, "compression require metadata")
+        if cmdline.hashtree:
+            errexit(1, "hash tree can't be used with compression")
+        #the number of data blocks is known only after the compression
+        metadata["compress"] = (cmdline.compress,
+                                max(1, cmdline.chunksize*1024 //
+                                    sbx.datasize) * sbx.datasize, 0)
+    if cmdline.parity:
+        if cmdline.nometa:
+            errexit(1, "parity require metadata")
+        try:
+            k, m = [int(v) for v in cmdline.parity.split(",")]
+            seqbox.RSCodec(k, m)
+        except (ValueError, seqbox.SbxError):
+            errexit(1, "invalid parity '%s'" % (cmdline.parity))
+        metadata["parity"] = (k, m)
+    return seqbox.getParity(metadata, sbx.datasize)
+
+
+def checkmeta(cmdline, sbx, metadata):
+    """
+    Encode a trial block 0, with a placeholder of the right size for the
+    hash, raising SbxError if the metadata can't fit in it
+    """
+    if cmdline.nometa:
+        return
+    trial = seqbox.SbxBlock(ver=sbx.ver)
+    trial.metadata = dict(metadata)
+    if cmdline.hash != "none":
+        trial.metadata["hash"] = seqbox.encodeMultihash(
+            cmdline.hash, bytes(hashlib.new(cmdline.hash).digest_size))
+    trial.encode()
+
+
+def checkversion(cmdline, sbx):
+    """
+    Refuse a hash, hash tree, parity & compression combination too big for
+    the block 0 of this version, even with empty names
+    """
+    metadata = {"filename":"", "sbxname":"", "filesize":0,
+                "filedatetime":0, "sbxdatetime":0}
+    setlayoutmeta(cmdline, sbx, metadata)
+    try:
+        checkmeta(cmdline, sbx, metadata)
+    except seqbox.SbxError:
+        errexit(1, ("%s hash & the options requested can't fit in the " +
+                    "metadata of SBX v%i blocks") % (cmdline.hash, sbx.ver))
+
+
+def getbulkfilelist(masks, recurse):
+    """Expand masks & dirs to a list of (filename, relative sbx name)"""
+    filelist = []
+    for mask in masks:
+        if glob.has_magic(mask):
+            names = sorted(glob.glob(mask))
+        else:
+            names = [mask]
+        for name in names:
+            if os.path.isdir(name):
+                if not recurse:
+                    errexit(1, "'%s' is a directory! (use -r)" % (name))
+                for root, dirs, files in os.walk(name):
+                    dirs.sort()
+                    for fn in sorted(files):
+                        fullname = os.path.join(root, fn)
+                        filelist.append((fullname,
+                                         os.path.relpath(fullname, name)))
+            elif os.path.isfile(name):
+                filelist.append((name, os.path.split(name)[1]))
+            else:
+                errexit(1, "file '%s' not found" % (name))
+    return filelist
+
+
+def bulk_encode(cmdline, uid):
+    """Encode many files to a path, spreading the work on a process pool"""
+    if uid != "r":
+        errexit(1, "custom UID can't be used in bulk mode")
+    if cmdline.stripe or cmdline.replica or cmdline.compress:
+        errexit(1, ("stripes, replicas & compression can't be used in " +
+                    "bulk mode"))
+    destpath = cmdline.destpath
+    if not os.path.isdir(destpath):
+        errexit(1, "path '%s' not found" % (destpath))
+
+    filelist = getbulkfilelist(cmdline.filename, cmdline.recurse)
+    if len(filelist) == 0:
+        errexit(1, "nothing to encode!")
+
+    sbx = seqbox.SbxBlock(ver=cmdline.sbxver)
+    checkversion(cmdline, sbx)
+    splitblocks = max(1, cmdline.split*1024*1024 // sbx.datasize)
+    #check the parameters, and keep the ranges aligned to the parity groups
+    parity = setlayoutmeta(cmdline, sbx, {"filesize":0})
+    if parity:
+        k = parity["k"]
+        splitblocks = max(k, splitblocks // k * k)
+    manifest = {}
+    sbxfilenames = set()
+    for filename, relname in filelist:
+        sbxfilename = os.path.join(destpath, relname + ".sbx")
+        if sbxfilename in sbxfilenames:
+            errexit(1, "SBX file '%s' would be created twice!" % (sbxfilename))
+        sbxfilenames.add(sbxfilename)
+        if os.path.exists(sbxfilename) and not cmdline.overwrite:
+            errexit(1, "SBX file '%s' already exists!" % (sbxfilename))
+        filesize = os.path.getsize(filename)
+        manifest[sbxfilename] = {
+            "filename":filename,
+            "sbxfilename":sbxfilename,
+            "uid":binascii.hexlify(seqbox.SbxBlock().uid).decode(),
+            "sbxver":cmdline.sbxver,
+            "filesize":filesize,
+            "filedatetime":int(os.path.getmtime(filename)),
+            "blocks":(filesize + sbx.datasize - 1) // sbx.datasize}
+
+    print("encoding %i file(s) to '%s' with %i job(s)..." %
+          (len(manifest), destpath, cmdline.jobs))
+    errors = 0
+    starttime = time()
+    with ProcessPoolExecutor(max_workers=cmdline.jobs) as executor:
+        #create all the containers and submit small files as a whole, while
+        #big ones get splitted in ranges of blocks
+        tasks = {}
+        done = 0
+        for sbxfilename, info in manifest.items():
+            uid = binascii.unhexlify(info["uid"])
+            metadata = {"filesize":info["filesize"],
+                        "filename":os.path.split(info["filename"])[1],
+                        "sbxname":os.path.split(sbxfilename)[1],
+                        "filedatetime":info["filedatetime"],
+                        "sbxdatetime":int(time())}
+            parity = setlayoutmeta(cmdline, sbx, metadata)
+            info["pending"] = 0
+            try:
+                checkmeta(cmdline, sbx, metadata)
+            except seqbox.SbxError as err:
+                info["error"] = "names too long - %s" % (err)
+                done += 1
+                errors += 1
+                print("error encoding '%s': %s" %
+                      (info["filename"], info["error"]))
+                continue
+            try:
+                os.makedirs(os.path.dirname(sbxfilename), exist_ok=True)
+                with open(sbxfilename, "wb") as fout:
+                    fout.truncate(blockpos(info["blocks"]+1, sbx.blocksize,
+                                           cmdline.nometa))
+            except OSError as err:
+                info["error"] = str(err)
+                done += 1
+                errors += 1
+                print("error encoding '%s': %s" %
+                      (info["filename"], info["error"]))
+                continue
+            args = (info["filename"], sbxfilename, cmdline.sbxver, uid,
+                    cmdline.password)
+            #the devices are probed here, just once, not by every worker
+            iosizes = {
+                "readsize":seqbox.getIOConfig(info["filename"])["readsize"],
+                "writesize":seqbox.getIOConfig(sbxfilename,
+                                               write=True)["writesize"]}
+            if info["blocks"] <= splitblocks:
+                tasks[executor.submit(encode_file, *args, cmdline.nometa,
+                                      metadata, cmdline.hash,
+                                      info["blocks"], parity,
+                                      **iosizes)] = sbxfilename
+                info["pending"] += 1
+            else:
+                if not cmdline.nometa:
+                    tasks[executor.submit(encode_meta, *args[1:], metadata,
+                                          info["filename"], cmdline.hash,
+                                          **iosizes)] = sbxfilename
+                    info["pending"] += 1
+                for firstblock in range(1, info["blocks"]+1, splitblocks):
+                    lastblock = min(firstblock + splitblocks - 1,
+                                    info["blocks"])
+                    tasks[executor.submit(encode_blocks, *args,
+                                          cmdline.nometa, firstblock,
+                                          lastblock, False, parity,
+                                          **iosizes)] = sbxfilename
+                    info["pending"] += 1
+
+        for task in as_completed(tasks):
+            info = manifest[tasks[task]]
+            info["pending"] -= 1
+            try:
+                res = task.result()
+                #only the metadata tasks return the hash
+                if isinstance(res, bytes) and res:
+                    info["hash"] = binascii.hexlify(
+                        seqbox.encodeMultihash(cmdline.hash, res)).decode()
+            except Exception as err:
+                #also a worker crashed, or a broken pool
+                info["error"] = str(err) or type(err).__name__
+            if info["pending"] == 0:
+                done += 1
+                if "error" in info:
+                    errors += 1
+                    print("error encoding '%s': %s" %
+                          (info["filename"], info["error"]))
+                print("%.1f%% - files: %i/%i" %
+                      (done*100.0/len(manifest), done, len(manifest)),
+                      " ", end="\r", flush=True)
+
+    totsize = 0
+    for info in manifest.values():
+        del info["pending"]
+        if not "error" in info:
+            totsize += info["filesize"]
+    etime = max(time()-starttime, 0.001)
+    print("\nfiles encoded: %i - errors: %i - %.2fMB/s" %
+          (len(manifest)-errors, errors, totsize/(1024*1024)/etime))
+
+    manifestname = os.path.join(destpath, cmdline.manifest)
+    with open(manifestname, "w") as fman:
+        json.dump(list(manifest.values()), fman, indent=2)
+    print("manifest saved to '%s'" % (manifestname))
+    if errors:
+        errexit(1, "%i file(s) not encoded!" % (errors))
 
 
 def main():
 
     cmdline = get_cmdline()
 
-    filename = cmdline.filename
-    sbxfilename = cmdline.sbxfilename
-    if not sbxfilename:
-        sbxfilename = os.path.split(filename)[1] + ".sbx"
-    elif os.path.isdir(sbxfilename):
-        sbxfilename = os.path.join(sbxfilename,
-                                   os.path.split(filename)[1] + ".sbx")
-    if os.path.exists(sbxfilename) and not cmdline.overwrite:
-        errexit(1, "SBX file '%s' already exists!" % (sbxfilename))
-        
     #parse eventual custom uid
     uid = cmdline.uid
     if uid !="r":
@@ -102,61 +721,121 @@ def main():
         except:
             errexit(1, "invalid UID")
 
+    if cmdline.destpath:
+        bulk_encode(cmdline, uid)
+        return
+    if len(cmdline.filename) > 2:
+        errexit(1, "too many files! (use -d for bulk mode)")
+
+    filename = cmdline.filename[0]
+    sbxfilename = None
+    if len(cmdline.filename) > 1:
+        sbxfilename = cmdline.filename[1]
+    if not sbxfilename:
+        sbxfilename = os.path.split(filename)[1] + ".sbx"
+    elif os.path.isdir(sbxfilename):
+        sbxfilename = os.path.join(sbxfilename,
+                                   os.path.split(filename)[1] + ".sbx")
+    sbxfilenames = [sbxfilename] + cmdline.stripe
+    for name in sbxfilenames:
+        if os.path.exists(name) and not cmdline.overwrite:
+            errexit(1, "SBX file '%s' already exists!" % (name))
+    replicas = []
+    for path in cmdline.replica:
+        if os.path.isdir(path):
+            path = os.path.join(path, os.path.split(sbxfilename)[1])
+        if os.path.exists(path) and not cmdline.overwrite:
+            errexit(1, "SBX file '%s' already exists!" % (path))
+        replicas.append(path)
+    if len(set(sbxfilenames + replicas)) != len(sbxfilenames + replicas):
+        errexit(1, "the same file is used twice as output!")
+
     if not os.path.exists(filename):
         errexit(1, "file '%s' not found" % (filename))
     filesize = os.path.getsize(filename)
 
-    fout = open(sbxfilename, "wb", buffering=1024*1024)
+    sbx = seqbox.SbxBlock(uid=uid, ver=cmdline.sbxver, pswd=cmdline.password)
+    checkversion(cmdline, sbx)
+    blocks = (filesize + sbx.datasize - 1) // sbx.datasize
 
-    #calc hash - before all processing, and not while reading the file,
-    #just to be cautious
-    if not cmdline.nometa:
-        print("hashing file '%s'..." % (filename))
-        sha256 = getsha256(filename)
-        print("SHA256",binascii.hexlify(sha256).decode())
+    metadata = {"filesize":filesize,
+                "filename":os.path.split(filename)[1],
+                "sbxname":os.path.split(sbxfilenames[0])[1],
+                "filedatetime":int(os.path.getmtime(filename)),
+                "sbxdatetime":int(time())}
+    parity = setlayoutmeta(cmdline, sbx, metadata)
+    try:
+        checkmeta(cmdline, sbx, metadata)
+    except seqbox.SbxError as err:
+        errexit(1, "names too long - %s" % (err))
 
-    fin = open(filename, "rb", buffering=1024*1024)
-    print("creating file '%s'..." % sbxfilename)
+    for name in sbxfilenames + replicas:
+        try:
+            open(name, "wb").close()
+        except OSError as err:
+            errexit(1, "can't create SBX file '%s': %s" % (name, err))
+    extent = 0
+    if cmdline.stripe:
+        extent = (max(1, cmdline.stripesize*1024 // sbx.blocksize) *
+                  sbx.blocksize)
+        sbxfilename = sbxfilenames
+    #encode once, and write the blocks to all the replicas at the same time
+    fout = None
+    if replicas:
+        #a stripe set is reported as a whole
+        try:
+            fout = ReplicaWriter([opensbx(sbxfilename, extent)] +
+                                 [open(name, "r+b") for name in replicas],
+                                 [" + ".join(sbxfilenames)] + replicas)
+        except OSError as err:
+            errexit(1, "can't open SBX file: %s" % (err))
+
+
+    #compressed data go first, as the metadata need their size
+    if cmdline.compress:
+        for name in sbxfilenames + replicas:
+            print("creating file '%s'..." % name)
+        encode_compressed(filename, sbxfilename, sbx.ver, sbx.uid,
+                          cmdline.password, metadata, cmdline.jobs, extent,
+                          fout)
+        print("100%  ")
 
-    sbx = seqbox.SbxBlock(uid=uid, ver=cmdline.sbxver, pswd=cmdline.password)
-    
     #write metadata block 0
     if not cmdline.nometa:
-        sbx.metadata = {"filesize":filesize,
-                        "filename":os.path.split(filename)[1],
-                        "sbxname":os.path.split(sbxfilename)[1],
-                        "filedatetime":int(os.path.getmtime(filename)),
-                        "sbxdatetime":int(time()),
-                        "hash":b'\x12\x20'+sha256} #multihash
-        fout.write(sbx.encode())
-    
+        if cmdline.hash != "none":
+            print("hashing file '%s'..." % (filename))
+        digest = encode_meta(sbxfilename, sbx.ver, sbx.uid, cmdline.password,
+                             metadata, filename, cmdline.hash, extent, fout)
+        if cmdline.hash != "none":
+            print(seqbox.hashnames[cmdline.hash],
+                  binascii.hexlify(digest).decode())
+
     #write all other blocks
-    ticks = 0
-    updatetime = time() 
-    while True:
-        buffer = fin.read(sbx.datasize)
-        if len(buffer) < sbx.datasize:
-            if len(buffer) == 0:
-                break
-        sbx.blocknum += 1
-        sbx.data = buffer
-        fout.write(sbx.encode())
+    if not cmdline.compress:
+        for name in sbxfilenames + replicas:
+            print("creating file '%s'..." % name)
+        encode_blocks(filename, sbxfilename, sbx.ver, sbx.uid,
+                      cmdline.password, cmdline.nometa, 1, blocks,
+                      progress=True, parity=parity, extent=extent, fout=fout)
+        print("100%  ")
+    errors = 0
+    if fout:
+        fout.close()
+        for name, size, speed, error in fout.report():
+            if error:
+                errors += 1
+                print("  '%s': error - %s" % (name, error))
+            else:
+                print("  '%s': %i bytes - %.2fMB/s" %
+                      (name, size, speed/(1024*1024)))
 
-        #some progress update
-        if time() > updatetime:
-            print("%.1f%%" % (fin.tell()*100.0/filesize), " ",
-                  end="\r", flush=True)
-            updatetime = time() + .1
-        
-    print("100%  ")
-    fin.close()
-    fout.close()
-
-    totblocks = sbx.blocknum if cmdline.nometa else sbx.blocknum + 1
-    sbxfilesize = totblocks * sbx.blocksize
+    sbxfilesize = sum(os.path.getsize(name) for name in sbxfilenames)
+    totblocks = sbxfilesize // sbx.blocksize
     overhead = 100.0 * sbxfilesize / filesize - 100 if filesize > 0 else 0
     print("SBX file size: %i - blocks: %i - overhead: %.1f%%" %
           (sbxfilesize, totblocks, overhead))
+    if errors:
+        errexit(1, "%i SBX file(s) not written!" % (errors))
 
 
 if __name__ == '__main__':
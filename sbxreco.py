@@ -29,6 +29,7 @@ import argparse
 import binascii
 import sqlite3
 import time
+from collections import OrderedDict
 
 import seqbox
 
@@ -57,12 +58,20 @@ def get_cmdline():
                         help="UID(s) to recover")
     parser.add_argument("-f", "--fill", action="store_true", default=False,
                         help="fill-in missing blocks")
+    parser.add_argument("-s", "--sparse", action="store_true", default=False,
+                        help="fill-in missing blocks leaving holes")
     parser.add_argument("-i", "--info", action="store_true", default=False,
                         help="show info on recoverable sbx file(s)")
     parser.add_argument("-p", "--password", type=str, default="",
                         help="encrypt with password", metavar="pass")
     parser.add_argument("-o", "--overwrite", action="store_true", default=False,
                         help="overwrite existing sbx file(s)")
+    parser.add_argument("-sw", "--sweep", action="store_true", default=False,
+                        help=("read every source just once, from start to " +
+                              "end, recovering all the UIDs at the same time"))
+    parser.add_argument("--handles", type=int, default=64,
+                        help="sweep mode: max SBX files open at once",
+                        metavar="n")
     res = parser.parse_args()
     return res
 
@@ -81,6 +90,9 @@ class RecDB():
     def __init__(self, dbfilename):
         self.connection = sqlite3.connect(dbfilename)
         self.cursor = self.connection.cursor()
+        #the UIDs summary kept by SbxScan, if not from an older version
+        self.cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'sbx_uidstats'")
+        self.hasstats = self.cursor.fetchone() is not None
 
     def GetMetaFromUID(self, uid):
         meta = {}
@@ -109,16 +121,49 @@ class RecDB():
         if res:
             return(res[0])
 
-    def GetBlocksCountFromUID(self, uid):
+    def GetUIDStats(self, uid):
+        stats = {"blocks":0, "nums":0, "dups":0, "minnum":-1, "maxnum":-1,
+                 "expected":-1, "missing":0}
         c = self.cursor
-        c.execute("SELECT uid from sbx_blocks where uid = '%i' group by num order by num" % (uid))
-        return len(c.fetchall())
+        if self.hasstats:
+            c.execute("SELECT blocks, nums, dups, minnum, maxnum, expected, gaps from sbx_uidstats where uid = '%i'" % (uid))
+            res = c.fetchone()
+            if res:
+                (stats["blocks"], stats["nums"], stats["dups"],
+                 stats["minnum"], stats["maxnum"], stats["expected"],
+                 gaps) = res
+                for gap in gaps.split(",") if gaps else []:
+                    first, _, last = gap.partition("-")
+                    stats["missing"] += int(last or first) - int(first) + 1
+        else:
+            c.execute("SELECT COUNT(*), COUNT(DISTINCT num), MIN(num), MAX(num) from sbx_blocks where uid = '%i'" % (uid))
+            res = c.fetchone()
+            if res[0]:
+                (stats["blocks"], stats["nums"],
+                 stats["minnum"], stats["maxnum"]) = res
+                stats["dups"] = stats["blocks"] - stats["nums"]
+                #from the first data block, without a metadata block
+                stats["missing"] = (stats["maxnum"] + 1 - stats["nums"] -
+                                    min(stats["minnum"], 1))
+        return stats
+
+    def GetBlocksCountFromUID(self, uid):
+        return self.GetUIDStats(uid)["nums"]
 
     def GetBlocksListFromUID(self, uid):
         c = self.cursor
         c.execute("SELECT num, fileid, pos from sbx_blocks where uid = '%i' group by num order by num" % (uid))
         return c.fetchall()
 
+    def GetBlocksRangeFromUID(self, uid):
+        stats = self.GetUIDStats(uid)
+        return stats["minnum"], stats["maxnum"]
+
+    def GetBlocksListFromSource(self, fileid):
+        c = self.connection.cursor()
+        c.execute("SELECT uid, num, pos from sbx_blocks where fileid = '%i' order by pos" % (fileid))
+        return c
+
     def GetUIDDataList(self):
         c = self.cursor
         c.execute("SELECT * from sbx_uids")
@@ -142,16 +187,207 @@ def uniquifyFileName(filename):
     return filename
 
 
+def rebuildgroup(sbx, codec, parity, groupnum, blockpos, finlist):
+    """
+    Rebuild the missing blocks (data & parity) of a parity group, reading
+    the available ones from the sources. Return a dict blocknum:payload.
+    """
+    k, m = codec.k, codec.m
+    firstblock = groupnum * k + 1
+    count = min(k, parity["datablocks"] - firstblock + 1)
+    blocknums = (list(range(firstblock, firstblock + count)) +
+                 [None] * (k - count) +
+                 [parity["firstblock"] + groupnum * m + j for j in range(m)])
+    blocks = {}
+    for idx, blocknum in enumerate(blocknums):
+        if blocknum in blockpos:
+            fileid, bpos = blockpos[blocknum]
+            fin = finlist[fileid]
+            fin.seek(bpos, 0)
+            try:
+                sbx.decode(fin.read(sbx.blocksize))
+            except seqbox.SbxDecodeError:
+                continue
+            blocks[idx] = sbx.data
+    res = codec.decode(blocks, count, sbx.datasize)
+    if res is None:
+        return {}
+    rebuilt = {firstblock + idx:data for idx, data in res.items()}
+    #with all the data available, the lost parity blocks can be redone too
+    if len([idx for idx in blocks if idx >= k]) < m:
+        payloads = [blocks[idx] if idx in blocks else res[idx]
+                    for idx in range(count)]
+        for j, data in enumerate(codec.encode(payloads)):
+            if not k + j in blocks:
+                rebuilt[blocknums[k + j]] = data
+    return rebuilt
+
+
+class OutputPool():
+    """Keep at most n output files open, closing the least recently used"""
+
+    def __init__(self, maxopen):
+        self.maxopen = max(1, maxopen)
+        self.files = OrderedDict()
+
+    def get(self, filename):
+        fout = self.files.pop(filename, None)
+        if fout is None:
+            if len(self.files) >= self.maxopen:
+                self.files.popitem(last=False)[1].close()
+            fout = open(filename, "r+b", buffering=64*1024)
+        self.files[filename] = fout
+        return fout
+
+    def close(self):
+        for fout in self.files.values():
+            fout.close()
+        self.files.clear()
+
+
+def sweep(cmdline, db, uidDataList, uid_list):
+    """
+    Recover all the UIDs at the same time, reading every source just once
+    in order of position, and writing every block at its place in its SBX
+    file. Missing blocks are then rebuilt, filled in or left as holes.
+    Return the list of (uid, missing blocks).
+    """
+    targets = {}
+    for uidcount, uid in enumerate(uid_list, 1):
+        sbx = seqbox.SbxBlock(ver=uidDataList[uid], pswd=cmdline.password)
+        hexuid = binascii.hexlify(uid.to_bytes(6, byteorder="big")).decode()
+        meta = db.GetMetaFromUID(uid)
+        sbxname = meta.get("sbxname", hexuid + ".sbx")
+        if cmdline.destpath:
+            sbxname = os.path.join(cmdline.destpath, sbxname)
+        if not cmdline.overwrite:
+            sbxname = uniquifyFileName(sbxname)
+        print("UID %s (%i/%i) to: '%s'" %
+              (hexuid, uidcount, len(uid_list), sbxname))
+        open(sbxname, "wb").close()
+        firstnum, lastnum = db.GetBlocksRangeFromUID(uid)
+        #without block 0 the file start with block 1
+        targets[uid] = {"sbx":sbx, "sbxname":sbxname, "meta":meta,
+                        "base":0 if firstnum == 0 else 1,
+                        "lastnum":lastnum, "found":set()}
+
+    pool = OutputPool(cmdline.handles)
+    for fileid, sourcename in db.GetSourcesList():
+        print("reading '%s'..." % (sourcename))
+        fin = open(sourcename, "rb",
+                   buffering=seqbox.getIOConfig(sourcename)["readsize"])
+        sourcesize = max(1, fin.seek(0, 2))
+        fin.seek(0, 0)
+        updatetime = time.time() - 1
+        for uid, num, pos in db.GetBlocksListFromSource(fileid):
+            if not uid in targets:
+                continue
+            target = targets[uid]
+            if num in target["found"]:
+                continue
+            sbx = target["sbx"]
+            #the blocks are in order, so the seeks just skip ahead
+            if fin.tell() != pos:
+                fin.seek(pos, 0)
+            buffer = fin.read(sbx.blocksize)
+            fout = pool.get(target["sbxname"])
+            outpos = (num - target["base"]) * sbx.blocksize
+            if fout.tell() != outpos:
+                fout.seek(outpos, 0)
+            fout.write(buffer)
+            target["found"].add(num)
+
+            #some progress report
+            if time.time() > updatetime:
+                print("  %.1f%%" % (pos*100.0/sourcesize), end="\r",
+                      flush=True)
+                updatetime = time.time() + .5
+        fin.close()
+        print("  100%  ")
+    pool.close()
+
+    #now the missing blocks, one file at a time
+    uiderrlist = []
+    for uid in uid_list:
+        target = targets[uid]
+        sbx = target["sbx"]
+        sbxname = target["sbxname"]
+        base = target["base"]
+        found = target["found"]
+        lastnum = target["lastnum"]
+        parity = None
+        with open(sbxname, "r+b") as fout:
+            if base == 0:
+                fout.seek(0, 0)
+                try:
+                    sbx.decode(fout.read(sbx.blocksize))
+                    parity = seqbox.getParity(sbx.metadata, sbx.datasize)
+                except seqbox.SbxDecodeError:
+                    pass
+            if parity:
+                codec = seqbox.RSCodec(parity["k"], parity["m"])
+                blockpos = {num:(0, (num - base) * sbx.blocksize)
+                            for num in found}
+                groupsdone = set()
+                rebuilt = {}
+                lastnum = seqbox.getLastBlockNum(sbx.metadata, sbx.datasize)
+            missingblocks = 0
+            rebuiltblocks = 0
+            for b in range(max(1, base), lastnum + 1):
+                if b in found:
+                    continue
+                if parity:
+                    if b <= parity["datablocks"]:
+                        groupnum = (b - 1) // parity["k"]
+                    elif b >= parity["firstblock"]:
+                        groupnum = (b - parity["firstblock"]) // parity["m"]
+                    else:
+                        groupnum = None
+                    if groupnum is not None and not groupnum in groupsdone:
+                        groupsdone.add(groupnum)
+                        rebuilt.update(rebuildgroup(sbx, codec, parity,
+                                                    groupnum, blockpos,
+                                                    {0:fout}))
+                    if b in rebuilt:
+                        sbx.blocknum = b
+                        sbx.data = rebuilt.pop(b)
+                        fout.seek((b - base) * sbx.blocksize, 0)
+                        fout.write(sbx.encode())
+                        rebuiltblocks += 1
+                        continue
+                #positional writes leave holes anyway
+                if cmdline.fill:
+                    sbx.blocknum = b
+                    sbx.data = bytes(sbx.datasize)
+                    fout.seek((b - base) * sbx.blocksize, 0)
+                    fout.write(sbx.encode())
+                missingblocks += 1
+        #set sbx date&time
+        meta = target["meta"]
+        if "sbxdatetime" in meta:
+            if meta["sbxdatetime"] >= 0:
+                os.utime(sbxname, (int(time.time()), meta["sbxdatetime"]))
+        if rebuiltblocks or missingblocks:
+            hexuid = binascii.hexlify(uid.to_bytes(6, byteorder="big")).decode()
+            print("UID %s - blocks rebuilt using parity: %i - missing: %i" %
+                  (hexuid, rebuiltblocks, missingblocks))
+        if missingblocks > 0:
+            uiderrlist.append((uid, missingblocks))
+    return uiderrlist
+
+
 def report(db, uidDataList, blocksizes):
     """Create a report with the info obtained by SbxScan"""
     #just the basic info in CSV format for the moment
 
-    print('\n"UID", "filesize", "sbxname", "filename", "filedatetime"')
+    print('\n"UID", "filesize", "sbxname", "filename", "filedatetime", ' +
+          '"blocks", "missing"')
 
     for uid in uidDataList:
         hexdigits = binascii.hexlify(uid.to_bytes(6, byteorder="big")).decode()
         metadata = db.GetMetaFromUID(uid)
-        blocksnum = db.GetBlocksCountFromUID(uid)
+        stats = db.GetUIDStats(uid)
+        blocksnum = stats["nums"]
         filename = metadata["filename"] if "filename" in metadata else ""
         sbxname = metadata["sbxname"] if "sbxname" in metadata else ""
         if "filesize" in metadata:
@@ -164,8 +400,9 @@ def report(db, uidDataList, blocksizes):
                 filedatetime = time.strftime("%Y-%m-%d %H:%M:%S",
                                      time.localtime(metadata["filedatetime"]))
         
-        print('"%s", %i, "%s", "%s", "%s"' %
-              (hexdigits, filesize, sbxname, filename, filedatetime))
+        print('"%s", %i, "%s", "%s", "%s", %i, %i' %
+              (hexdigits, filesize, sbxname, filename, filedatetime,
+               blocksnum, stats["missing"]))
 
 
 def report_err(db, uiderrlist, uidDataList, blocksizes):
@@ -191,6 +428,16 @@ def report_err(db, uiderrlist, uidDataList, blocksizes):
               (hexdigits, blocksnum, errblocks, filesize, sbxname, filename))
 
 
+def report_done(db, uiderrlist, uidDataList, blocksizes):
+    """Final message, with the errors report if needed"""
+    print("\ndone.")
+    if len(uiderrlist) == 0:
+        print("all SBx files recovered with no errors!")
+    else:
+        print("errors detected in %i SBx file(s)!" % len(uiderrlist))
+        report_err(db, uiderrlist, uidDataList, blocksizes)
+
+
 def main():
 
     cmdline = get_cmdline()
@@ -252,6 +499,11 @@ def main():
     print("recovering SBX files...")
     uid_list = sorted(set(uidRecoList))
 
+    if cmdline.sweep:
+        uiderrlist = sweep(cmdline, db, uidDataList, uid_list)
+        report_done(db, uiderrlist, uidDataList, blocksizes)
+        return
+
     #open all the sources
     finlist = {}
     for key, value in db.GetSourcesList():
@@ -284,7 +536,8 @@ def main():
 
         if not cmdline.overwrite:
             sbxname = uniquifyFileName(sbxname)
-        fout = open(sbxname, "wb", buffering = 1024*1024)
+        fout = open(sbxname, "wb",
+                    buffering=seqbox.getIOConfig(sbxname, True)["writesize"])
 
         blockdatalist = db.GetBlocksListFromUID(uid)
         #read 1 block to initialize the correct block parameters
@@ -299,26 +552,66 @@ def main():
             print(err)
             errexit(1, "invalid block at offset %s file '%s'" %
                     (hex(bpos), fin.name))
-        
+
+        #with parity blocks, missing blocks can be rebuilt
+        parity = None
+        if sbx.blocknum == 0:
+            parity = seqbox.getParity(sbx.metadata, sbx.datasize)
+        if parity:
+            codec = seqbox.RSCodec(parity["k"], parity["m"])
+            blockpos = {num:(fileid, pos)
+                        for num, fileid, pos in blockdatalist}
+            groupsdone = set()
+            rebuilt = {}
+
         lastblock = -1
         ticks = 0
         missingblocks = 0
+        rebuiltblocks = 0
         updatetime = time.time() -1
         maxbnum =  blockdatalist[-1][0]
+        if parity:
+            #a final marker, to rebuild the lost blocks at the end too
+            blockdatalist.append(
+                (seqbox.getLastBlockNum(sbx.metadata, sbx.datasize) + 1,
+                 None, None))
         #loop trough the block list and recreate SBx file
         for blockdata in blockdatalist:
             bnum = blockdata[0]
             #check for missing blocks and fill in
             if bnum != lastblock +1 and bnum != 1:
                 for b in range(lastblock+1, bnum):
+                    if parity and b > 0:
+                        if b <= parity["datablocks"]:
+                            groupnum = (b - 1) // parity["k"]
+                        elif b >= parity["firstblock"]:
+                            groupnum = ((b - parity["firstblock"]) //
+                                        parity["m"])
+                        else:
+                            groupnum = None
+                        if groupnum is not None and not groupnum in groupsdone:
+                            groupsdone.add(groupnum)
+                            rebuilt.update(rebuildgroup(sbx, codec, parity,
+                                                        groupnum, blockpos,
+                                                        finlist))
+                        if b in rebuilt:
+                            sbx.blocknum = b
+                            sbx.data = rebuilt.pop(b)
+                            fout.write(sbx.encode())
+                            rebuiltblocks += 1
+                            continue
                     #no point in an empty block 0 with no metadata
-                    if b > 0 and cmdline.fill:
+                    if b > 0 and cmdline.sparse:
+                        fout.seek(sbx.blocksize, 1)
+                    elif b > 0 and cmdline.fill:
                         sbx.blocknum = b
                         sbx.data = bytes(sbx.datasize)
                         buffer = sbx.encode()
                         fout.write(buffer)
                     missingblocks += 1
 
+            if blockdata[1] is None:
+                break
             fin = finlist[blockdata[1]]
             bpos = blockdata[2]
             fin.seek(bpos, 0)
@@ -333,6 +626,9 @@ def main():
                       end="\r", flush=True)
                 updatetime = time.time() + .5
 
+        #the blocks skipped at the end still count in the file size
+        if cmdline.sparse:
+            fout.truncate()
         fout.close()
         #set sbx date&time
         if "sbxdatetime" in meta:
@@ -340,16 +636,13 @@ def main():
                 os.utime(sbxname, (int(time.time()), meta["sbxdatetime"]))
         
         print()
+        if rebuiltblocks > 0:
+            print("  blocks rebuilt using parity: %i" % (rebuiltblocks))
         if missingblocks > 0:
             uiderrlist.append((uid, missingblocks))
             totblockserr += missingblocks
 
-    print("\ndone.")
-    if len(uiderrlist) == 0:
-        print("all SBx files recovered with no errors!")
-    else:
-        print("errors detected in %i SBx file(s)!" % len(uiderrlist))
-        report_err(db, uiderrlist, uidDataList, blocksizes)
+    report_done(db, uiderrlist, uidDataList, blocksizes)
 
             
 if __name__ == '__main__':
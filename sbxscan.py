@@ -26,7 +26,11 @@
 import os
 import sys
 import argparse
+import hashlib
 import binascii
+import re
+import queue
+import threading
 from time import sleep, time
 import sqlite3
 
@@ -45,7 +49,7 @@ def get_cmdline():
     parser.add_argument("-v", "--version", action='version', 
                         version='SeqBox - Sequenced Box container - ' +
                         'Scanner v%s - (C) 2017 by M.Pontello' % PROGRAM_VER) 
-    parser.add_argument("filename", action="store", nargs="+",
+    parser.add_argument("filename", action="store", nargs="*",
                         help="file(s) to scan")
     parser.add_argument("-d", "--database", action="store", dest="dbfilename",
                         metavar="filename",
@@ -55,12 +59,34 @@ def get_cmdline():
                         help=("offset from the start"), metavar="n")
     parser.add_argument("-st", "--step", type=int, default=0,
                         help=("scan step"), metavar="n")
-    parser.add_argument("-b", "--buffer", type=int, default=1024,
-                        help=("read buffer in KB"), metavar="n")
+    parser.add_argument("-b", "--buffer", type=int, default=0,
+                        help=("read buffer in KB (0 = tuned for the device)"),
+                        metavar="n")
     parser.add_argument("-sv", "--sbxver", type=int, default=1,
                         help="SBX blocks version to search for", metavar="n")
     parser.add_argument("-p", "--password", type=str, default="",
                         help="encrypt with password", metavar="pass")
+    parser.add_argument("--uid", action="store", nargs="+", metavar="uid",
+                        help="UID(s) to search for, ignoring all the others")
+    parser.add_argument("-uc", "--until-complete", action="store_true",
+                        default=False, dest="untilcomplete",
+                        help="stop when all the requested UIDs are complete")
+    parser.add_argument("-c", "--catalog", action="store_true", default=False,
+                        help=("keep the database as a catalog, scanning " +
+                              "only new or changed files"))
+    parser.add_argument("-m", "--merge", action="store", nargs="+",
+                        metavar="filename", default=[],
+                        help="merge other scan databases in this one")
+    parser.add_argument("--passes", type=int, default=1,
+                        help=("scan passes: the first one skip the areas " +
+                              "with read errors (or slow reads), the others " +
+                              "retry them with smaller reads"), metavar="n")
+    parser.add_argument("--slow", type=float, default=0,
+                        help=("first pass: skip ahead after a read slower " +
+                              "than this (0=never)"), metavar="secs")
+    parser.add_argument("-r", "--recover", action="store", metavar="path",
+                        help=("recover the SBX files in this path as soon " +
+                              "as all their blocks are found"))
     res = parser.parse_args()
     return res
 
@@ -82,10 +108,407 @@ def getFileSize(filename):
         os.close(ftemp)
 
 
+def getFingerprint(filename, filesize, samples=16, samplesize=64*1024):
+    """
+    Identify a file/device by size, date, device & inode, plus a hash of
+    some samples spread on all its size (if any are requested)
+    """
+    st = os.stat(filename)
+    samplehash = None
+    if samples:
+        d = hashlib.sha256()
+        try:
+            with open(filename, "rb") as fin:
+                for i in range(samples):
+                    fin.seek(max(0, (filesize - samplesize) * i //
+                                 max(1, samples - 1)), 0)
+                    d.update(fin.read(samplesize))
+            samplehash = d.hexdigest()
+        except OSError:
+            #a source with read errors is never skipped
+            pass
+    return {"size":filesize, "mtime":st.st_mtime_ns, "dev":st.st_dev,
+            "ino":st.st_ino, "samplehash":samplehash}
+
+
+class SourceReader():
+    """
+    Read a file/device taking note of the read errors and of the time
+    taken, instead of aborting, so the scan can skip the bad areas
+    """
+
+    def __init__(self, filename, buffering):
+        self.fin = open(filename, "rb", buffering=buffering)
+        self.failed = False
+        self.elapsed = 0
+
+    def read(self, pos, size):
+        starttime = time()
+        try:
+            self.fin.seek(pos, 0)
+            data = self.fin.read(size)
+            self.failed = False
+        except OSError:
+            data = b""
+            self.failed = True
+        self.elapsed = time() - starttime
+        return data
+
+    def close(self):
+        self.fin.close()
+
+
+def createTables(c):
+    """Create the tables, if not already there"""
+    c.execute("CREATE TABLE IF NOT EXISTS sbx_source (id INTEGER, name TEXT)")
+    c.execute("CREATE TABLE IF NOT EXISTS sbx_meta (uid INTEGER, size INTEGER, name TEXT, sbxname TEXT, datetime INTEGER, sbxdatetime INTEGER, fileid INTEGER)")
+    c.execute("CREATE TABLE IF NOT EXISTS sbx_uids (uid INTEGER, ver INTEGER)")
+    c.execute("CREATE TABLE IF NOT EXISTS sbx_blocks (uid INTEGER, num INTEGER, fileid INTEGER, pos INTEGER )")
+    c.execute("CREATE INDEX IF NOT EXISTS blocks ON sbx_blocks (uid, num, pos)")
+    #fingerprint & scan parameters of every source, to skip it if unchanged
+    c.execute("CREATE TABLE IF NOT EXISTS sbx_scans (fileid INTEGER, size INTEGER, mtime INTEGER, dev INTEGER, ino INTEGER, samplehash TEXT, params TEXT, complete INTEGER)")
+    #areas of every source not read yet, because of errors or slowness
+    c.execute("CREATE TABLE IF NOT EXISTS sbx_badmap (fileid INTEGER, start INTEGER, end INTEGER, status TEXT)")
+    #summary of every UID, kept up to date during the scan
+    c.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'sbx_uidstats'")
+    newstats = c.fetchone() is None
+    c.execute("CREATE TABLE IF NOT EXISTS sbx_uidstats (uid INTEGER PRIMARY KEY, blocks INTEGER, nums INTEGER, dups INTEGER, minnum INTEGER, maxnum INTEGER, expected INTEGER, gaps TEXT)")
+    if newstats:
+        #a catalog from a previous version
+        rebuildStats(c)
+
+
+def forgetSource(c, fileid):
+    """Remove all the info from a source, to scan it again"""
+    c.execute("SELECT DISTINCT uid FROM sbx_blocks WHERE fileid = ?",
+              (fileid,))
+    uidnums = [row[0] for row in c.fetchall()]
+    for table, field in (("sbx_blocks", "fileid"), ("sbx_meta", "fileid"),
+                         ("sbx_scans", "fileid"), ("sbx_badmap", "fileid"),
+                         ("sbx_source", "id")):
+        c.execute("DELETE FROM %s WHERE %s = ?" % (table, field), (fileid,))
+    rebuildStats(c, uidnums)
+
+
+def mergeDB(conn, dbfilename):
+    """
+    Merge another scan database, renumbering its sources and skipping the
+    ones already completely scanned. Return the sources merged & total.
+    """
+    c = conn.cursor()
+    c.execute("ATTACH DATABASE ? AS other", (dbfilename,))
+    c.execute("SELECT name FROM other.sqlite_master WHERE type = 'table' AND name = 'sbx_scans'")
+    hasscans = c.fetchone() is not None
+    c.execute("SELECT name FROM other.sqlite_master WHERE type = 'table' AND name = 'sbx_badmap'")
+    hasbadmap = c.fetchone() is not None
+    c.execute("SELECT name FROM other.sqlite_master WHERE type = 'table' AND name = 'sbx_uidstats'")
+    hasstats = c.fetchone() is not None
+    c.execute("SELECT IFNULL(MAX(id), 0) FROM sbx_source")
+    offset = c.fetchone()[0]
+    c.execute("SELECT id, name FROM other.sbx_source")
+    sources = c.fetchall()
+    merged = 0
+    for fileid, name in sources:
+        if hasscans:
+            #device & inode are not compared, as they are local to a system
+            c.execute("SELECT size, mtime, samplehash, params FROM other.sbx_scans WHERE fileid = ? AND complete = 1", (fileid,))
+            row = c.fetchone()
+            if row:
+                c.execute("SELECT fileid FROM sbx_scans WHERE size = ? AND mtime = ? AND samplehash = ? AND params = ? AND complete = 1", row)
+                if c.fetchone():
+                    continue
+        newid = fileid + offset
+        c.execute("INSERT INTO sbx_source (id, name) VALUES (?, ?)",
+                  (newid, name))
+        c.execute("INSERT INTO sbx_blocks (uid, num, fileid, pos) SELECT uid, num, ?, pos FROM other.sbx_blocks WHERE fileid = ?", (newid, fileid))
+        c.execute("INSERT INTO sbx_meta (uid, size, name, sbxname, datetime, sbxdatetime, fileid) SELECT uid, size, name, sbxname, datetime, sbxdatetime, ? FROM other.sbx_meta WHERE fileid = ?", (newid, fileid))
+        if hasscans:
+            c.execute("INSERT INTO sbx_scans (fileid, size, mtime, dev, ino, samplehash, params, complete) SELECT ?, size, mtime, dev, ino, samplehash, params, complete FROM other.sbx_scans WHERE fileid = ?", (newid, fileid))
+        if hasbadmap:
+            c.execute("INSERT INTO sbx_badmap (fileid, start, end, status) SELECT ?, start, end, status FROM other.sbx_badmap WHERE fileid = ?", (newid, fileid))
+        merged += 1
+    if hasstats:
+        #the blocks expected can't be found again from the tables
+        c.execute("INSERT OR IGNORE INTO sbx_uidstats (uid, expected) SELECT uid, expected FROM other.sbx_uidstats WHERE uid IN (SELECT uid FROM sbx_blocks WHERE fileid > ?)",
+                  (offset,))
+        c.execute("UPDATE sbx_uidstats SET expected = (SELECT expected FROM other.sbx_uidstats WHERE other.sbx_uidstats.uid = sbx_uidstats.uid) WHERE expected < 0 AND uid IN (SELECT uid FROM other.sbx_uidstats WHERE expected > 0)")
+    c.execute("SELECT DISTINCT uid FROM sbx_blocks WHERE fileid > ?",
+              (offset,))
+    rebuildStats(c, [row[0] for row in c.fetchall()])
+    c.execute("INSERT INTO sbx_uids (uid, ver) SELECT DISTINCT uid, ver FROM other.sbx_uids WHERE uid NOT IN (SELECT uid FROM sbx_uids)")
+    conn.commit()
+    c.execute("DETACH DATABASE other")
+    c.close()
+    return merged, len(sources)
+
+
+def checkRun(buffer, sbx, uid, blocknum):
+    """
+    Count how many blocks at the start of the buffer continue a run of
+    contiguous blocks: same magic & UID, next block numbers and good CRC
+    """
+    mv = memoryview(buffer)
+    blocksize = sbx.blocksize
+    count = 0
+    for p in range(0, len(mv) - blocksize + 1, blocksize):
+        if (mv[p:p+4] != sbx.magic or mv[p+6:p+12] != uid or
+            int.from_bytes(mv[p+12:p+16], byteorder='big') !=
+            blocknum + count):
+            break
+        count += 1
+    #then the CRCs of all the blocks that look right, in one go
+    crcs = seqbox.checkBlocksCRC(mv[:count * blocksize], blocksize, sbx.ver)
+    return crcs.index(False) if False in crcs else count
+
+
+def updatetarget(target, sbx):
+    """
+    Mark a block of a requested UID as found; return 1 just the first time
+    the UID is complete
+    """
+    if target["done"]:
+        return 0
+    bitmap = target["bitmap"]
+    byte, bit = divmod(sbx.blocknum, 8)
+    if byte >= len(bitmap):
+        bitmap.extend(bytes(byte - len(bitmap) + 1))
+    if not bitmap[byte] & (1 << bit):
+        bitmap[byte] |= 1 << bit
+        target["found"] += 1
+    if (sbx.blocknum == 0 and "filesize" in sbx.metadata and
+        target["expected"] < 0):
+        #metadata block + data & index blocks
+        target["expected"] = seqbox.getLastBlockNum(sbx.metadata,
+                                                    sbx.datasize) + 1
+    if target["found"] == target["expected"]:
+        target["done"] = True
+        return 1
+    return 0
+
+
+def addArea(areas, start, end, status):
+    """Add an area to a list, merging it with the last one if adjacent"""
+    if areas and areas[-1][1] == start and areas[-1][2] == status:
+        areas[-1][1] = end
+    else:
+        areas.append([start, end, status])
+
+
+def newStats():
+    """An empty UID summary"""
+    return {"bitmap":bytearray(), "blocks":0, "nums":0, "dups":0,
+            "min":-1, "max":-1, "expected":-1, "dirty":False}
+
+
+def updatestats(stat, first, count=1):
+    """Add to a UID summary a sequence of blocks found"""
+    bitmap = stat["bitmap"]
+    last = first + count - 1
+    if last // 8 >= len(bitmap):
+        bitmap.extend(bytes(last // 8 + 1 - len(bitmap)))
+    #whole bytes at once, the bits at the ends one by one
+    num = first
+    while num <= last:
+        byte, bit = divmod(num, 8)
+        if bit == 0 and num + 7 <= last:
+            nbytes = (last + 1 - num) // 8
+            found = bin(int.from_bytes(bitmap[byte:byte+nbytes],
+                                       byteorder='big')).count("1")
+            bitmap[byte:byte+nbytes] = b"\xff" * nbytes
+            stat["dups"] += found
+            stat["nums"] += nbytes * 8 - found
+            num += nbytes * 8
+            continue
+        if bitmap[byte] & (1 << bit):
+            stat["dups"] += 1
+        else:
+            bitmap[byte] |= 1 << bit
+            stat["nums"] += 1
+        num += 1
+    stat["blocks"] += count
+    stat["min"] = first if stat["min"] < 0 else min(stat["min"], first)
+    stat["max"] = max(stat["max"], last)
+    stat["dirty"] = True
+
+
+def getGaps(bitmap, last, first=0):
+    """The block numbers missing from first up to last, as a list of ranges"""
+    size = last // 8 + 1 if last >= 0 else 0
+    bits = bytes(bitmap[:size]).ljust(size, b"\x00")
+    gaps = []
+    def addgap(start, end):
+        start = max(start, first)
+        end = min(end, last)
+        if start > end:
+            return
+        if gaps and gaps[-1][1] == start - 1:
+            gaps[-1][1] = end
+        else:
+            gaps.append([start, end])
+    #whole empty bytes at once, the others bit by bit
+    for m in re.finditer(rb"\x00+|[^\xff]", bits):
+        if bits[m.start()] == 0:
+            addgap(m.start() * 8, m.end() * 8 - 1)
+        else:
+            for bit in range(8):
+                if not bits[m.start()] & (1 << bit):
+                    num = m.start() * 8 + bit
+                    if num <= last:
+                        addgap(num, num)
+    return ",".join(str(first) if first == end else "%i-%i" % (first, end)
+                    for first, end in gaps)
+
+
+def loadStats(c, uidnum):
+    """A UID summary from the database, to go on updating it"""
+    stat = newStats()
+    c.execute("SELECT blocks, nums, dups, minnum, maxnum, expected, gaps FROM sbx_uidstats WHERE uid = ?",
+              (uidnum,))
+    row = c.fetchone()
+    if row and row[4] >= 0:
+        (stat["blocks"], stat["nums"], stat["dups"], stat["min"],
+         stat["max"], stat["expected"], gaps) = row
+        bitmap = bytearray(b"\xff" * (stat["max"] // 8 + 1))
+        bitmap[-1] &= (1 << (stat["max"] % 8 + 1)) - 1
+        for gap in gaps.split(",") if gaps else []:
+            first, _, end = gap.partition("-")
+            for num in range(int(first), min(int(end or first),
+                                              stat["max"]) + 1):
+                bitmap[num // 8] &= ~(1 << (num % 8))
+        stat["bitmap"] = bitmap
+    elif row:
+        stat["expected"] = row[5]
+    return stat
+
+
+def saveStats(c, uidnum, stat):
+    """Store a UID summary, with the gaps up to the last block expected"""
+    last = stat["expected"] - 1 if stat["expected"] > 0 else stat["max"]
+    #without a metadata block, count from the first data block
+    first = 0 if stat["min"] == 0 else 1
+    c.execute("INSERT OR REPLACE INTO sbx_uidstats (uid, blocks, nums, dups, minnum, maxnum, expected, gaps) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+              (uidnum, stat["blocks"], stat["nums"], stat["dups"],
+               stat["min"], stat["max"], stat["expected"],
+               getGaps(stat["bitmap"], last, first)))
+    stat["dirty"] = False
+
+
+def flushStats(c, stats):
+    """Write the UID summaries changed since the last time"""
+    for uid, stat in stats.items():
+        if stat["dirty"]:
+            saveStats(c, int.from_bytes(uid, byteorder='big'), stat)
+
+
+def getStats(c, stats, uid):
+    """The summary of a UID, loaded from the database the first time"""
+    if not uid in stats:
+        stats[uid] = loadStats(c, int.from_bytes(uid, byteorder='big'))
+    return stats[uid]
+
+
+def rebuildStats(c, uidnums=None):
+    """
+    Compute again the summary of some (or all) the UIDs from the blocks
+    table, keeping the expected number of blocks already known
+    """
+    if uidnums is None:
+        c.execute("SELECT uid FROM sbx_uids")
+        uidnums = [row[0] for row in c.fetchall()]
+    for uidnum in uidnums:
+        stat = newStats()
+        c.execute("SELECT expected FROM sbx_uidstats WHERE uid = ?",
+                  (uidnum,))
+        row = c.fetchone()
+        if row:
+            stat["expected"] = row[0]
+        c.execute("SELECT num, COUNT(*) FROM sbx_blocks WHERE uid = ? GROUP BY num",
+                  (uidnum,))
+        for num, count in c.fetchall():
+            updatestats(stat, num)
+            stat["blocks"] += count - 1
+            stat["dups"] += count - 1
+        saveStats(c, uidnum, stat)
+
+
+def uniquifyFileName(filename):
+    count = 0
+    name, ext = os.path.splitext(filename)
+    while os.path.exists(filename):
+        count += 1
+        filename = name + "(%i)" % count + ext
+    return filename
+
+
+def recoverUIDs(dbfilename, destpath, uidqueue, results):
+    """
+    Recovery worker: rebuild the SBX file of every UID handed over by the
+    scan, reading the blocks from the sources at the positions already
+    committed in the database
+    """
+    conn = sqlite3.connect(dbfilename)
+    c = conn.cursor()
+    finlist = {}
+    while True:
+        uid = uidqueue.get()
+        if uid is None:
+            break
+        uidnum = int.from_bytes(uid, byteorder='big')
+        hexuid = binascii.hexlify(uid).decode()
+        c.execute("SELECT sbxname, sbxdatetime FROM sbx_meta WHERE uid = ?",
+                  (uidnum,))
+        meta = c.fetchone()
+        sbxname = meta[0] if meta and meta[0] else hexuid + ".sbx"
+        sbxname = uniquifyFileName(os.path.join(destpath,
+                                                os.path.split(sbxname)[1]))
+        c.execute("SELECT ver FROM sbx_uids WHERE uid = ?", (uidnum,))
+        blocksize = seqbox.SbxBlock(ver=c.fetchone()[0]).blocksize
+        c.execute("SELECT num, fileid, pos FROM sbx_blocks WHERE uid = ? GROUP BY num ORDER BY num",
+                  (uidnum,))
+        try:
+            with open(sbxname, "wb", buffering=seqbox.getIOConfig(
+                      sbxname, True)["writesize"]) as fout:
+                for num, fileid, pos in c.fetchall():
+                    if not fileid in finlist:
+                        c.execute("SELECT name FROM sbx_source WHERE id = ?",
+                                  (fileid,))
+                        finlist[fileid] = open(c.fetchone()[0], "rb")
+                    fin = finlist[fileid]
+                    fin.seek(pos, 0)
+                    fout.write(fin.read(blocksize))
+            if meta and meta[1] >= 0:
+                os.utime(sbxname, (int(time()), meta[1]))
+            results.append((hexuid, sbxname, None))
+        except OSError as err:
+            results.append((hexuid, sbxname, str(err)))
+    for fin in finlist.values():
+        fin.close()
+    c.close()
+    conn.close()
+
+
 def main():
 
     cmdline = get_cmdline()
 
+    #UIDs to search for, with a bitmap of the blocks found
+    targets = {}
+    if cmdline.uid:
+        for hexuid in cmdline.uid:
+            try:
+                uid = int(hexuid[-12:], 16).to_bytes(6, byteorder='big')
+            except ValueError:
+                errexit(1, "invalid UID '%s'" % (hexuid))
+            targets[uid] = {"bitmap":bytearray(), "found":0, "expected":-1,
+                            "done":False}
+    elif cmdline.untilcomplete:
+        errexit(1, "--until-complete require --uid")
+    uidsleft = len(targets)
+    if cmdline.recover and not os.path.isdir(cmdline.recover):
+        errexit(1, "path '%s' not found!" % (cmdline.recover))
+
+    if not cmdline.filename and not cmdline.merge:
+        errexit(1, "nothing to scan or merge!")
     filenames = []
     for filename in cmdline.filename:
         if os.path.exists(filename):
@@ -98,17 +521,27 @@ def main():
     if os.path.isdir(dbfilename):
         dbfilename = os.path.join(dbfilename, "sbxscan.db3")
 
-    #create database tables
-    print("creating '%s' database..." % (dbfilename))
-    if os.path.exists(dbfilename):
-        os.remove(dbfilename)
+    #create database tables, or keep the existing ones of a catalog
+    usecatalog = cmdline.catalog or cmdline.merge
+    if os.path.exists(dbfilename) and usecatalog:
+        print("updating '%s' database..." % (dbfilename))
+    else:
+        print("creating '%s' database..." % (dbfilename))
+        if os.path.exists(dbfilename):
+            os.remove(dbfilename)
     conn = sqlite3.connect(dbfilename)
     c = conn.cursor()
-    c.execute("CREATE TABLE sbx_source (id INTEGER, name TEXT)")
-    c.execute("CREATE TABLE sbx_meta (uid INTEGER, size INTEGER, name TEXT, sbxname TEXT, datetime INTEGER, sbxdatetime INTEGER, fileid INTEGER)")
-    c.execute("CREATE TABLE sbx_uids (uid INTEGER, ver INTEGER)")
-    c.execute("CREATE TABLE sbx_blocks (uid INTEGER, num INTEGER, fileid INTEGER, pos INTEGER )")
-    c.execute("CREATE INDEX blocks ON sbx_blocks (uid, num, pos)")
+    createTables(c)
+    conn.commit()
+
+    for otherdbfilename in cmdline.merge:
+        if not os.path.exists(otherdbfilename):
+            errexit(1, "file '%s' not found!" % (otherdbfilename))
+        if os.path.samefile(otherdbfilename, dbfilename):
+            errexit(1, "can't merge '%s' in itself!" % (otherdbfilename))
+        print("merging '%s'..." % (otherdbfilename))
+        merged, total = mergeDB(conn, otherdbfilename)
+        print("  sources merged: %i/%i" % (merged, total))
 
     #scan all the files/devices 
     sbx = seqbox.SbxBlock(ver=cmdline.sbxver,pswd=cmdline.password)
@@ -121,89 +554,390 @@ def main():
     scanstep = cmdline.step
     if scanstep == 0:
         scanstep = sbx.blocksize
+    #a source scanned with different parameters can have other blocks
+    params = "ver=%i offset=%i step=%i pswd=%s" % (
+        cmdline.sbxver, offset, scanstep,
+        hashlib.sha256(cmdline.password.encode()).hexdigest()[:16]
+        if cmdline.password else "")
+
+    #UIDs & sources already in the catalog
+    c.execute("SELECT uid FROM sbx_uids")
+    for row in c.fetchall():
+        uids[row[0].to_bytes(6, byteorder='big')] = True
+    c.execute("SELECT IFNULL(MAX(id), 0) FROM sbx_source")
+    fileid = c.fetchone()[0]
+    #summaries of the UIDs found, by UID
+    stats = {}
 
+    #the UIDs complete during the scan are recovered at the same time
+    if cmdline.recover:
+        uidqueue = queue.Queue()
+        recovered = []
+        uidsqueued = set()
+        recoverthread = threading.Thread(target=recoverUIDs,
+                                         args=(dbfilename, cmdline.recover,
+                                               uidqueue, recovered),
+                                         daemon=True)
+        recoverthread.start()
+
+    complete = False
     for filename in filenames:
         filenum += 1
-        print("scanning file/device '%s' (%i/%i)..." %
-              (filename, filenum, len(filenames)))
         filesize = getFileSize(filename)
+        #the samples are read (seeking all over) just for a catalog
+        fingerprint = getFingerprint(filename, filesize,
+                                     16 if usecatalog else 0)
 
+        #skip the sources already scanned, even if renamed
+        c.execute("SELECT fileid, name FROM sbx_scans JOIN sbx_source ON sbx_source.id = sbx_scans.fileid WHERE size = ? AND mtime = ? AND dev = ? AND ino = ? AND samplehash = ? AND params = ? AND complete = 1",
+                  (fingerprint["size"], fingerprint["mtime"],
+                   fingerprint["dev"], fingerprint["ino"],
+                   fingerprint["samplehash"], params))
+        row = c.fetchone()
+        if row:
+            print("skipping file/device '%s' (%i/%i) - already scanned" %
+                  (filename, filenum, len(filenames)))
+            if row[1] != filename:
+                c.execute("UPDATE sbx_source SET name = ? WHERE id = ?",
+                          (filename, row[0]))
+                conn.commit()
+            continue
+        #changed or partially scanned sources are scanned again
+        flushStats(c, stats)
+        c.execute("SELECT id FROM sbx_source WHERE name = ?", (filename,))
+        for row in c.fetchall():
+            forgetSource(c, row[0])
+            stats.clear()
+
+        print("scanning file/device '%s' (%i/%i)..." %
+              (filename, filenum, len(filenames)))
+        fileid += 1
         c.execute("INSERT INTO sbx_source (id, name) VALUES (?, ?)",
-          (filenum, filename))
+          (fileid, filename))
         conn.commit()
 
-        fin = open(filename, "rb", buffering=cmdline.buffer*1024)
+        #no probe reads on a device that is likely failing
+        readsize = (cmdline.buffer*1024 or
+                    seqbox.getIOConfig(
+                        filename, probe=cmdline.passes == 1)["readsize"])
+        fin = SourceReader(filename, readsize)
         blocksfound = 0
         blocksmetafound = 0
         updatetime = time() - 1
         starttime = time()
         docommit = False
-        for pos in range(offset, filesize, scanstep):
-            fin.seek(pos, 0)
-            buffer = fin.read(sbx.blocksize)
-            #check for magic
-            if buffer[:4] == magic:
-                #check for valid block
-                try:
-                    sbx.decode(buffer)
-                    #update uids table & list
-                    if not sbx.uid in uids:
-                        uids[sbx.uid] = True
-                        c.execute(
-                            "INSERT INTO sbx_uids (uid, ver) VALUES (?, ?)",
-                            (int.from_bytes(sbx.uid, byteorder='big'),
-                             sbx.ver))
-                        docommit = True
-
-                    #update blocks table
-                    blocksfound+=1
-                    c.execute(
+        runsize = max(1, readsize // sbx.blocksize) * sbx.blocksize
+        run = None
+        window = None
+        #like ddrescue: the first pass skip the troubled areas, the others
+        #go back to them with small reads
+        passnum = 1
+        regions = []
+        skipped = []
+        skipsize = readsize
+        #a slow area to jump over, once past what was already read
+        jump = None
+        #in the retry passes: where an area read from its start failed, to
+        #trim it from its end, backward
+        trimfail = None
+        backward = False
+        retried = False
+        pos = offset
+        end = filesize
+        while True:
+            if pos >= end:
+                if not regions and skipped and passnum < cmdline.passes:
+                    passnum += 1
+                    regions, skipped = skipped, []
+                    c.execute("DELETE FROM sbx_badmap WHERE fileid = ?",
+                              (fileid,))
+                    c.executemany("INSERT INTO sbx_badmap (fileid, start, end, status) VALUES (?, ?, ?, ?)",
+                                  ((fileid, start, stop, status)
+                                   for start, stop, status in regions))
+                    conn.commit()
+                    print("\npass %i: %i area(s) to read again - %i bytes" %
+                          (passnum, len(regions),
+                           sum(stop - start for start, stop, status in
+                               regions)))
+                    #unbuffered, to read just a block at a time
+                    fin.close()
+                    fin = SourceReader(filename, 0)
+                    runsize = sbx.blocksize
+                    readsize = skipsize = min(scanstep, sbx.blocksize)
+                    window = None
+                if not regions:
+                    break
+                start, end, status = regions.pop(0)
+                pos = offset + ((start - offset + scanstep - 1) //
+                                scanstep * scanstep)
+                run = None
+                jump = None
+                trimfail = None
+                backward = False
+                retried = False
+                continue
+            nextpos = pos + scanstep
+            uidsdone = []
+            fin.failed = False
+            readend = None
+            #not past the end of the area or a pending jump, to not find
+            #blocks twice
+            limit = jump[0] if jump else end
+            if run:
+                #fast path: check in bulk the blocks that should continue
+                #the run, dropping back to the normal scan when they don't
+                uid, blocknum = run
+                buffer = fin.read(pos, min(runsize,
+                                           (limit - pos + sbx.blocksize - 1) //
+                                           sbx.blocksize * sbx.blocksize))
+                readend = pos + len(buffer)
+                count = checkRun(buffer, sbx, uid, blocknum)
+                if count:
+                    uidnum = int.from_bytes(uid, byteorder='big')
+                    c.executemany(
                         "INSERT INTO sbx_blocks (uid, num, fileid, pos) VALUES (?, ?, ?, ?)",
-                        (int.from_bytes(sbx.uid, byteorder='big'),
-                         sbx.blocknum, filenum, pos))
+                        ((uidnum, blocknum + i, fileid,
+                          pos + i * sbx.blocksize) for i in range(count)))
+                    updatestats(getStats(c, stats, uid), blocknum, count)
                     docommit = True
+                    blocksfound += count
+                    if uid in targets:
+                        for num in range(blocknum, blocknum + count):
+                            sbx.blocknum = num
+                            if updatetarget(targets[uid], sbx):
+                                uidsdone.append(uid)
+                runend = pos + count * sbx.blocksize
+                if count * sbx.blocksize == len(buffer) == runsize:
+                    run = (uid, blocknum + count)
+                    nextpos = runend
+                else:
+                    #go on from the first scan position after the run
+                    run = None
+                    nextpos = offset + ((runend - offset + scanstep - 1) //
+                                        scanstep * scanstep)
+            else:
+                #search the magic in a big window (overlapping the next one
+                #by a block less a byte, so no block is cut), instead of
+                #checking every position: fast even with a step of 1
+                if window is None or not winpos <= pos < winpos + readsize:
+                    winpos = pos
+                    #the retry passes read just the block at each position
+                    window = fin.read(pos, readsize + sbx.blocksize - 1
+                                      if passnum == 1 else sbx.blocksize)
+                    readend = winpos + readsize
+                winend = min(readsize, limit - winpos) + len(magic) - 1
+                p = window.find(magic, pos - winpos, winend)
+                while p != -1 and (winpos + p - offset) % scanstep:
+                    p = window.find(magic, p + 1, winend)
+                if p == -1:
+                    #go on from the first scan position after the window
+                    buffer = b""
+                    nextpos = offset + ((winpos + readsize - offset +
+                                         scanstep - 1) // scanstep * scanstep)
+                else:
+                    pos = winpos + p
+                    nextpos = pos + scanstep
+                    buffer = window[p:p+sbx.blocksize]
+                #skip other UIDs without checking the CRC
+                if buffer and (not cmdline.uid or cmdline.password or
+                               buffer[6:12] in targets):
+                    #check for valid block
+                    try:
+                        sbx.decode(buffer)
+                        if not cmdline.uid or sbx.uid in targets:
+                            #to recover them, all the UIDs are tracked
+                            if cmdline.recover and not sbx.uid in targets:
+                                targets[sbx.uid] = {"bitmap":bytearray(),
+                                                    "found":0, "expected":-1,
+                                                    "done":False}
+                            if sbx.uid in targets:
+                                if updatetarget(targets[sbx.uid], sbx):
+                                    uidsdone.append(sbx.uid)
+                            #update uids table & list
+                            if not sbx.uid in uids:
+                                uids[sbx.uid] = True
+                                c.execute(
+                                    "INSERT INTO sbx_uids (uid, ver) VALUES (?, ?)",
+                                    (int.from_bytes(sbx.uid, byteorder='big'),
+                                     sbx.ver))
+                                docommit = True
+
+                            #update blocks table
+                            blocksfound+=1
+                            c.execute(
+                                "INSERT INTO sbx_blocks (uid, num, fileid, pos) VALUES (?, ?, ?, ?)",
+                                (int.from_bytes(sbx.uid, byteorder='big'),
+                                 sbx.blocknum, fileid, pos))
+                            docommit = True
+                            stat = getStats(c, stats, sbx.uid)
+                            updatestats(stat, sbx.blocknum)
+
+                            #update meta table
+                            if sbx.blocknum == 0:
+                                blocksmetafound += 1
+                                if not "filedatetime" in sbx.metadata:
+                                    sbx.metadata["filedatetime"] = -1
+                                    sbx.metadata["sbxdatetime"] = -1
 
-                    #update meta table
-                    if sbx.blocknum == 0:
-                        blocksmetafound += 1
-                        if not "filedatetime" in sbx.metadata:
-                            sbx.metadata["filedatetime"] = -1
-                            sbx.metadata["sbxdatetime"] = -1
-
-                        c.execute(
-                            "INSERT INTO sbx_meta (uid , size, name, sbxname, datetime, sbxdatetime, fileid) VALUES (?, ?, ?, ?, ?, ?, ?)",
-                            (int.from_bytes(sbx.uid, byteorder='big'),
-                             sbx.metadata["filesize"],
-                             sbx.metadata["filename"], sbx.metadata["sbxname"],
-                             sbx.metadata["filedatetime"], sbx.metadata["sbxdatetime"],
-                             filenum))
-                        docommit = True
-
-                except seqbox.SbxDecodeError:
-                    pass
+                                c.execute(
+                                    "INSERT INTO sbx_meta (uid , size, name, sbxname, datetime, sbxdatetime, fileid) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                    (int.from_bytes(sbx.uid, byteorder='big'),
+                                     sbx.metadata["filesize"],
+                                     sbx.metadata["filename"], sbx.metadata["sbxname"],
+                                     sbx.metadata["filedatetime"], sbx.metadata["sbxdatetime"],
+                                     fileid))
+                                docommit = True
+                                if "filesize" in sbx.metadata:
+                                    stat["expected"] = seqbox.getLastBlockNum(
+                                        sbx.metadata, sbx.datasize) + 1
+
+                            #blocks of the same UID will likely follow
+                            if not sbx.encdec:
+                                run = (sbx.uid, sbx.blocknum + 1)
+                                nextpos = pos + sbx.blocksize
+
+                    except seqbox.SbxDecodeError:
+                        pass
+
+            #skip ahead (further every time) from the troubled areas,
+            #leaving them to the next passes
+            if fin.failed and passnum == 1:
+                addArea(skipped, pos, min(limit, pos + skipsize), "error")
+                nextpos = max(nextpos, min(limit, pos + skipsize))
+                skipsize = min(skipsize * 2, max(readsize, filesize // 100))
+                run = None
+                window = None
+            elif fin.failed:
+                #give the device some time, once per area
+                if not retried:
+                    sleep(.1 * 2 ** (passnum - 2))
+                    retried = True
+                if backward:
+                    #what's left between the edges is for the next passes
+                    addArea(skipped, trimfail, min(end, pos + readsize),
+                            "error")
+                    nextpos = end
+                elif passnum == 2:
+                    #trim the area from its end too, before going block by
+                    #block in the next passes
+                    trimfail = pos
+                    backward = True
+                    nextpos = offset + ((end - 1 - offset) // scanstep *
+                                        scanstep)
+                    if nextpos <= trimfail:
+                        addArea(skipped, trimfail, end, "error")
+                        nextpos = end
+                else:
+                    addArea(skipped, pos, min(end, pos + readsize), "error")
+                    nextpos = max(nextpos, pos + scanstep)
+                run = None
+                window = None
+            elif backward:
+                nextpos = pos - scanstep
+                if nextpos <= trimfail:
+                    addArea(skipped, trimfail, min(end, trimfail + readsize),
+                            "error")
+                    nextpos = end
+                run = None
+                window = None
+            elif (readend is not None and passnum == 1 and cmdline.slow and
+                  fin.elapsed > cmdline.slow and not jump):
+                #but only after what was already read
+                if readend < end:
+                    jump = (readend, min(end, readend + skipsize))
+                    addArea(skipped, *jump, "slow")
+                skipsize = min(skipsize * 2, max(readsize, filesize // 100))
+            elif readend is not None:
+                skipsize = readsize
+            if jump and nextpos >= jump[0]:
+                nextpos = max(nextpos,
+                              offset + ((jump[1] - offset + scanstep - 1) //
+                                        scanstep * scanstep))
+                jump = None
+                run = None
+
+            if uidsdone:
+                uidsleft -= len(uidsdone)
+                if cmdline.recover:
+                    #the recovery worker read the blocks from the database
+                    flushStats(c, stats)
+                    conn.commit()
+                    docommit = False
+                    for uid in uidsdone:
+                        if not uid in uidsqueued:
+                            uidsqueued.add(uid)
+                            uidqueue.put(uid)
 
             #status update
-            if (time() > updatetime) or (pos >= filesize - scanstep):
+            complete = cmdline.untilcomplete and uidsleft == 0
+            if (time() > updatetime) or (nextpos >= filesize) or complete:
                 etime = (time()-starttime)
                 if etime == 0:
                     etime = 1
-                print("%5.1f%% blocks: %i - meta: %i - files: %i - %.2fMB/s" %
-                      (pos*100.0/(filesize-scanstep), blocksfound,
-                       blocksmetafound, len(uids), pos/(1024*1024)/etime),
+                print("%5.1f%% blocks: %i - meta: %i - files: %i - %.2fMB/s%s" %
+                      (min(nextpos, filesize)*100.0/filesize, blocksfound,
+                       blocksmetafound, len(uids), pos/(1024*1024)/etime,
+                       " - skipped: %i" % len(skipped) if skipped else ""),
                       end = "\r", flush=True)
                 if docommit:
+                    flushStats(c, stats)
                     conn.commit()
                     docommit = False
                 updatetime = time() + .5
+
+            if complete:
+                break
+            pos = nextpos
             
         fin.close()
         print()
+        #what's left unread after all the passes
+        skipped += regions
+        c.execute("DELETE FROM sbx_badmap WHERE fileid = ?", (fileid,))
+        c.executemany("INSERT INTO sbx_badmap (fileid, start, end, status) VALUES (?, ?, ?, ?)",
+                      ((fileid, start, stop, status)
+                       for start, stop, status in skipped))
+        if skipped:
+            print("areas not read: %i - %i bytes" %
+                  (len(skipped),
+                   sum(stop - start for start, stop, status in skipped)))
+        #only a whole scan for every UID can be skipped next time
+        c.execute("INSERT INTO sbx_scans (fileid, size, mtime, dev, ino, samplehash, params, complete) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                  (fileid, fingerprint["size"], fingerprint["mtime"],
+                   fingerprint["dev"], fingerprint["ino"],
+                   fingerprint["samplehash"], params,
+                   int(not cmdline.uid and not complete and not skipped)))
+        flushStats(c, stats)
+        conn.commit()
+        if complete:
+            print("all requested UIDs complete!")
+            break
 
+    #drop the UIDs left without blocks by the sources scanned again
+    c.execute("DELETE FROM sbx_uids WHERE uid NOT IN (SELECT uid FROM sbx_blocks)")
+    c.execute("DELETE FROM sbx_uidstats WHERE uid NOT IN (SELECT uid FROM sbx_uids)")
+    conn.commit()
     c.close()
     conn.close()
 
     print("scan completed!")    
 
+    if cmdline.recover:
+        uidqueue.put(None)
+        recoverthread.join()
+        errors = 0
+        for hexuid, sbxname, error in recovered:
+            if error:
+                errors += 1
+                print("  UID %s: error - %s" % (hexuid, error))
+            else:
+                print("  UID %s recovered to '%s'" % (hexuid, sbxname))
+        print("SBX files recovered: %i - incomplete UIDs left: %i" %
+              (len(recovered) - errors,
+               sum(1 for target in targets.values() if not target["done"])))
+        if errors:
+            errexit(1, "%i SBX file(s) not recovered!" % (errors))
+
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,377 @@
+#!/usr/bin/env python3
+
+#--------------------------------------------------------------------------
+# SBXServe - Sequenced Box container HTTP Server
+#
+# Created: 19/10/2026
+#
+# Copyright (C) 2017 Marco Pontello - http://mark0.net/
+#
+# Licence:
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#--------------------------------------------------------------------------
+
+import os
+import sys
+import glob
+import asyncio
+import argparse
+import threading
+import email.utils
+import urllib.parse
+from collections import OrderedDict
+
+import seqbox
+
+PROGRAM_VER = "1.0.0"
+
+def get_cmdline():
+    """Evaluate command line parameters, usage & help."""
+    parser = argparse.ArgumentParser(
+             description=("serve the decoded content of SeqBox containers " +
+                          "over HTTP, with range requests"),
+             formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+             prefix_chars='-+', fromfile_prefix_chars='@')
+    parser.add_argument("-v", "--version", action='version',
+                        version='SeqBox - Sequenced Box container - ' +
+                        'Server v%s - (C) 2017 by M.Pontello' % PROGRAM_VER)
+    parser.add_argument("filename", action="store", nargs="+",
+                        help="SBX container(s) or mask(s) to serve")
+    parser.add_argument("-a", "--address", action="store", default="127.0.0.1",
+                        help="address to listen on")
+    parser.add_argument("-pt", "--port", type=int, default=8080,
+                        help="port to listen on", metavar="n")
+    parser.add_argument("-c", "--cache", type=int, default=64,
+                        help="blocks cache size in MB", metavar="n")
+    parser.add_argument("-p", "--password", type=str, default="",
+                        help="encrypt with password", metavar="pass")
+    res = parser.parse_args()
+    return res
+
+
+def errexit(errlev=1, mess=""):
+    """Display an error and exit."""
+    if mess != "":
+        sys.stderr.write("%s: error: %s\n" %
+                         (os.path.split(sys.argv[0])[1], mess))
+    sys.exit(errlev)
+
+
+class BlockCache():
+    """LRU cache of decoded blocks payloads, shared by all the files"""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.size = 0
+        self.blocks = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            data = self.blocks.get(key)
+            if data is not None:
+                self.blocks.move_to_end(key)
+            return data
+
+    def put(self, key, data):
+        with self.lock:
+            if key in self.blocks:
+                return
+            self.blocks[key] = data
+            self.size += len(data)
+            while self.size > self.maxsize and self.blocks:
+                self.size -= len(self.blocks.popitem(last=False)[1])
+
+
+class SbxFile():
+    """A SBX container, read block by block at the expected positions"""
+
+    def __init__(self, sbxfilename, password):
+        self.sbxfilename = sbxfilename
+        self.password = password
+        self.fin = open(sbxfilename, "rb")
+        self.lock = threading.Lock()
+        header = self.fin.read(4)
+        if password:
+            header = seqbox.EncDec(password, len(header)).xor(header)
+        if header[:3] != b"SBx" or not header[3] in seqbox.supported_vers:
+            raise seqbox.SbxDecodeError("not a SeqBox file!")
+        sbx = seqbox.SbxBlock(ver=header[3], pswd=password)
+        self.fin.seek(0, 0)
+        sbx.decode(self.fin.read(sbx.blocksize))
+        if sbx.blocknum != 0 or not "filesize" in sbx.metadata:
+            raise seqbox.SbxDecodeError("no metadata available")
+        if "compress" in sbx.metadata:
+            raise seqbox.SbxDecodeError("compressed containers not supported")
+        self.ver = sbx.ver
+        self.uid = sbx.uid
+        self.blocksize = sbx.blocksize
+        self.datasize = sbx.datasize
+        self.metadata = sbx.metadata
+        self.filesize = sbx.metadata["filesize"]
+        self.name = sbx.metadata.get("filename",
+                                     os.path.split(sbxfilename)[1])
+
+    def readblocks(self, firstblock, lastblock):
+        """Read & check a range of blocks, returning their payloads"""
+        with self.lock:
+            self.fin.seek(firstblock * self.blocksize, 0)
+            buffer = self.fin.read((lastblock - firstblock + 1) *
+                                   self.blocksize)
+        sbx = seqbox.SbxBlock(ver=self.ver, pswd=self.password)
+        payloads = []
+        for blocknum in range(firstblock, lastblock + 1):
+            p = (blocknum - firstblock) * self.blocksize
+            try:
+                sbx.decode(buffer[p:p+self.blocksize])
+            except seqbox.SbxDecodeError as err:
+                raise seqbox.SbxDecodeError("block %i: %s" % (blocknum, err))
+            if sbx.uid != self.uid or sbx.blocknum != blocknum:
+                raise seqbox.SbxDecodeError("block %i out of place" %
+                                            (blocknum))
+            pos = (blocknum - 1) * self.datasize
+            payloads.append(sbx.data[:max(0, self.filesize - pos)])
+        return payloads
+
+
+def readdata(sbxfile, cache, start, end):
+    """
+    Return the data from start to end (included), reading only the blocks
+    covering it that are not already in the cache
+    """
+    firstblock = start // sbxfile.datasize + 1
+    lastblock = end // sbxfile.datasize + 1
+    payloads = []
+    missing = []
+    for blocknum in range(firstblock, lastblock + 1):
+        data = cache.get((sbxfile.sbxfilename, blocknum))
+        payloads.append(data)
+        if data is None:
+            missing.append(blocknum)
+    #read the missing blocks in contiguous runs
+    while missing:
+        count = 1
+        while (count < len(missing) and
+               missing[count] == missing[0] + count):
+            count += 1
+        for i, data in enumerate(sbxfile.readblocks(missing[0],
+                                                    missing[0] + count - 1)):
+            cache.put((sbxfile.sbxfilename, missing[0] + i), data)
+            payloads[missing[0] + i - firstblock] = data
+        missing = missing[count:]
+    data = b"".join(payloads)
+    offset = start - (firstblock - 1) * sbxfile.datasize
+    return data[offset:offset + end - start + 1]
+
+
+def getrange(header, size):
+    """
+    Parse a single bytes range of a Range header. Return (start, end), None
+    to send the whole file, or False if not satisfiable.
+    """
+    unit, _, ranges = header.partition("=")
+    if unit.strip() != "bytes" or "," in ranges:
+        return None
+    first, _, last = ranges.strip().partition("-")
+    try:
+        if first == "":
+            #suffix range: the last n bytes
+            start, end = max(0, size - int(last)), size - 1
+        else:
+            start = int(first)
+            end = min(int(last), size - 1) if last else size - 1
+    except ValueError:
+        return None
+    if start > end or start >= size:
+        return False
+    return start, end
+
+
+class SbxServer():
+    """Serve the decoded SBX files, each at /filename"""
+
+    def __init__(self, sbxfiles, cache, chunkblocks=64):
+        self.sbxfiles = sbxfiles
+        self.cache = cache
+        self.chunkblocks = chunkblocks
+
+    async def sendheaders(self, writer, status, reason, headers):
+        lines = ["HTTP/1.1 %i %s" % (status, reason)]
+        lines += ["%s: %s" % (key, value) for key, value in headers]
+        lines += ["Connection: close", "", ""]
+        writer.write("\r\n".join(lines).encode("latin-1"))
+        await writer.drain()
+
+    async def senderror(self, writer, status, reason, headers=()):
+        body = ("%i %s\n" % (status, reason)).encode()
+        await self.sendheaders(writer, status, reason,
+                               [("Content-Type", "text/plain"),
+                                ("Content-Length", len(body))] +
+                               list(headers))
+        writer.write(body)
+
+    async def handle(self, reader, writer):
+        peer = writer.get_extra_info("peername")
+        method = path = "-"
+        status = 0
+        try:
+            request = await reader.readline()
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                key, _, value = line.decode("latin-1").partition(":")
+                headers[key.strip().lower()] = value.strip()
+            try:
+                method, path, version = request.decode("latin-1").split()
+            except ValueError:
+                status = 400
+                await self.senderror(writer, status, "Bad Request")
+                return
+            status = await self.respond(writer, method,
+                                        urllib.parse.unquote(path), headers)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            print("%s - %s %s %i" % (peer[0] if peer else "-", method, path,
+                                     status))
+            writer.close()
+
+    async def respond(self, writer, method, path, headers):
+        if method not in ("GET", "HEAD"):
+            await self.senderror(writer, 405, "Method Not Allowed",
+                                 [("Allow", "GET, HEAD")])
+            return 405
+
+        #the list of the files available
+        if path == "/":
+            body = "".join("%s\t%i\n" % (urllib.parse.quote(name),
+                                         sbxfile.filesize)
+                           for name, sbxfile in
+                           sorted(self.sbxfiles.items())).encode()
+            await self.sendheaders(writer, 200, "OK",
+                                   [("Content-Type", "text/plain"),
+                                    ("Content-Length", len(body))])
+            if method == "GET":
+                writer.write(body)
+            return 200
+
+        sbxfile = self.sbxfiles.get(path[1:])
+        if not sbxfile:
+            await self.senderror(writer, 404, "Not Found")
+            return 404
+
+        size = sbxfile.filesize
+        status, reason = 200, "OK"
+        start, end = 0, size - 1
+        rheaders = []
+        if "range" in headers:
+            res = getrange(headers["range"], size)
+            if res is False:
+                await self.senderror(writer, 416,
+                                     "Range Not Satisfiable",
+                                     [("Content-Range", "bytes */%i" % size)])
+                return 416
+            elif res:
+                start, end = res
+                status, reason = 206, "Partial Content"
+                rheaders.append(("Content-Range",
+                                 "bytes %i-%i/%i" % (start, end, size)))
+
+        #read & check the first chunk before committing to a response
+        loop = asyncio.get_running_loop()
+        chunksize = self.chunkblocks * sbxfile.datasize
+        data = b""
+        if method == "GET" and size > 0:
+            try:
+                data = await loop.run_in_executor(
+                    None, readdata, sbxfile, self.cache, start,
+                    min(end, start + chunksize - 1))
+            except (seqbox.SbxDecodeError, OSError) as err:
+                await self.senderror(writer, 500, "Internal Server Error")
+                print("'%s': %s" % (sbxfile.sbxfilename, err))
+                return 500
+
+        rheaders += [("Content-Type", "application/octet-stream"),
+                     ("Content-Length", end - start + 1),
+                     ("Accept-Ranges", "bytes"),
+                     ("Content-Disposition",
+                      "attachment; filename*=UTF-8''%s" %
+                      urllib.parse.quote(sbxfile.name))]
+        if "filedatetime" in sbxfile.metadata:
+            rheaders.append(("Last-Modified", email.utils.formatdate(
+                sbxfile.metadata["filedatetime"], usegmt=True)))
+        await self.sendheaders(writer, status, reason, rheaders)
+        if method == "HEAD":
+            return status
+
+        pos = start
+        while data:
+            writer.write(data)
+            await writer.drain()
+            pos += len(data)
+            if pos > end:
+                break
+            try:
+                data = await loop.run_in_executor(
+                    None, readdata, sbxfile, self.cache, pos,
+                    min(end, pos + chunksize - 1))
+            except (seqbox.SbxDecodeError, OSError) as err:
+                #too late for an error status: just drop the connection
+                print("'%s': %s" % (sbxfile.sbxfilename, err))
+                break
+        return status
+
+
+def main():
+
+    cmdline = get_cmdline()
+
+    sbxfiles = {}
+    for mask in cmdline.filename:
+        names = sorted(glob.glob(mask)) if glob.has_magic(mask) else [mask]
+        for sbxfilename in names:
+            if not os.path.isfile(sbxfilename):
+                errexit(1, "file '%s' not found!" % (sbxfilename))
+            try:
+                sbxfile = SbxFile(sbxfilename, cmdline.password)
+            except (seqbox.SbxDecodeError, OSError) as err:
+                errexit(1, "'%s': %s" % (sbxfilename, err))
+            if sbxfile.name in sbxfiles:
+                errexit(1, "file name '%s' used by more SBX files!" %
+                        (sbxfile.name))
+            sbxfiles[sbxfile.name] = sbxfile
+    if len(sbxfiles) == 0:
+        errexit(1, "nothing to serve!")
+
+    server = SbxServer(sbxfiles, BlockCache(cmdline.cache*1024*1024))
+
+    async def serve():
+        srv = await asyncio.start_server(server.handle, cmdline.address,
+                                         cmdline.port)
+        print("serving %i file(s) on http://%s:%i/" %
+              (len(sbxfiles), cmdline.address, cmdline.port))
+        async with srv:
+            await srv.serve_forever()
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        print("\nstopped.")
+
+
+if __name__ == '__main__':
+    main()
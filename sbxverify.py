@@ -0,0 +1,315 @@
+#!/usr/bin/env python3
+
+#--------------------------------------------------------------------------
+# SBXVerify - Sequenced Box container Verifier
+#
+# Created: 19/10/2026
+#
+# Copyright (C) 2017 Marco Pontello - http://mark0.net/
+#
+# Licence:
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#--------------------------------------------------------------------------
+
+import os
+import sys
+import glob
+import json
+import hashlib
+import argparse
+import binascii
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from time import time
+
+import seqbox
+
+PROGRAM_VER = "1.0.0"
+
+def get_cmdline():
+    """Evaluate command line parameters, usage & help."""
+    parser = argparse.ArgumentParser(
+             description="verify the integrity of many SeqBox containers",
+             formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+             prefix_chars='-+', fromfile_prefix_chars='@')
+    parser.add_argument("-v", "--version", action='version',
+                        version='SeqBox - Sequenced Box container - ' +
+                        'Verifier v%s - (C) 2017 by M.Pontello' % PROGRAM_VER)
+    parser.add_argument("filename", action="store", nargs="+",
+                        help="SBX container(s), mask(s) or dir(s) to verify")
+    parser.add_argument("-r", "--recurse", action="store_true", default=False,
+                        help="search *.sbx files in directories")
+    parser.add_argument("-f", "--full", action="store_true", default=False,
+                        help="full check, including the crypto hash")
+    parser.add_argument("-j", "--jobs", type=int, default=0,
+                        help="worker processes (0 = tuned for the device)",
+                        metavar="n")
+    parser.add_argument("-b", "--buffer", type=int, default=0,
+                        help=("read buffer in KB (0 = tuned for the device)"),
+                        metavar="n")
+    parser.add_argument("-rp", "--report", action="store",
+                        metavar="filename", default="sbxverify.json",
+                        help="where to save the JSON report")
+    parser.add_argument("-p", "--password", type=str, default="",
+                        help="encrypt with password", metavar="pass")
+    res = parser.parse_args()
+    return res
+
+
+def errexit(errlev=1, mess=""):
+    """Display an error and exit."""
+    if mess != "":
+        sys.stderr.write("%s: error: %s\n" %
+                         (os.path.split(sys.argv[0])[1], mess))
+    sys.exit(errlev)
+
+
+def getfilelist(masks, recurse):
+    """Expand masks & dirs to a list of SBX files"""
+    filelist = []
+    for mask in masks:
+        if glob.has_magic(mask):
+            names = sorted(glob.glob(mask))
+        else:
+            names = [mask]
+        for name in names:
+            if os.path.isdir(name):
+                if not recurse:
+                    errexit(1, "'%s' is a directory! (use -r)" % (name))
+                for root, dirs, files in os.walk(name):
+                    dirs.sort()
+                    for fn in sorted(files):
+                        if fn.lower().endswith(".sbx"):
+                            filelist.append(os.path.join(root, fn))
+            elif os.path.isfile(name):
+                filelist.append(name)
+            else:
+                errexit(1, "file '%s' not found!" % (name))
+    return sorted(set(filelist))
+
+
+def getranges(numbers):
+    """Compact a sorted list of numbers in a list of [first, last] ranges"""
+    ranges = []
+    for num in numbers:
+        if ranges and ranges[-1][1] == num - 1:
+            ranges[-1][1] = num
+        else:
+            ranges.append([num, num])
+    return ranges
+
+
+def getblocknum(idx, base, extent, stride):
+    """The block number expected at a position, in blocks"""
+    if extent is None:
+        return base + idx
+    return base + idx // extent * stride + idx % extent
+
+
+def verify(sbxfilename, full=False, password="", bufsize=1024*1024):
+    """
+    Check every block of a container for header, CRC, UID and sequence.
+    A member of a stripe set is followed through its extents.
+    With full=True the data is also checked against the stored hash.
+    Return a dict with the results and the map of the bad blocks.
+    """
+    res = {"sbxfilename":sbxfilename, "status":"ok"}
+    try:
+        fin = open(sbxfilename, "rb")
+    except OSError as err:
+        res["status"] = "error"
+        res["error"] = str(err)
+        return res
+
+    with fin:
+        #check magic and get version
+        header = fin.read(4)
+        fin.seek(0, 0)
+        if password:
+            header = seqbox.EncDec(password, len(header)).xor(header)
+        if header[:3] != b"SBx" or not header[3] in seqbox.supported_vers:
+            res["status"] = "error"
+            res["error"] = "not a SeqBox file!"
+            return res
+        sbx = seqbox.SbxBlock(ver=header[3], pswd=password)
+        blocksize = sbx.blocksize
+        magic = sbx.magic
+        res["ver"] = sbx.ver
+
+        uid = None
+        base = None
+        #for a stripe member: the blocks in an extent, and the block
+        #numbers between the starts of two of them
+        extent = None
+        stride = 0
+        lastgood = -1
+        metadata = {}
+        badidx = []
+        blockidx = 0
+        hashcheck = False
+        lastblock = -1
+        datasize = 0
+        readsize = max(1, bufsize // blocksize) * blocksize
+        while True:
+            buffer = fin.read(readsize)
+            if len(buffer) == 0:
+                break
+            mv = memoryview(buffer)
+            #the CRCs of the whole buffer in one go, if not encrypted
+            crcs = (None if sbx.encdec else
+                    seqbox.checkBlocksCRC(buffer, blocksize, sbx.ver))
+            for p in range(0, len(buffer), blocksize):
+                block = mv[p:p+blocksize]
+                idx = blockidx
+                blockidx += 1
+                if sbx.encdec and len(block) == blocksize:
+                    block = memoryview(sbx.encdec.xor(block))
+                #check the basics: size, magic, CRC, UID & sequence
+                if (len(block) != blocksize or block[:4] != magic or
+                    not (crcs[p // blocksize] if crcs is not None else
+                         int.from_bytes(block[4:6], byteorder='big') ==
+                         binascii.crc_hqx(block[6:], sbx.ver))):
+                    badidx.append(idx)
+                    continue
+                if uid is None:
+                    uid = bytes(block[6:12])
+                elif block[6:12] != uid:
+                    badidx.append(idx)
+                    continue
+                blocknum = int.from_bytes(block[12:16], byteorder='big')
+                if base is None:
+                    base = blocknum - idx
+                expected = getblocknum(idx, base, extent, stride)
+                if extent is None and blocknum > expected:
+                    #a jump at the end of an extent (maybe among the last
+                    #bad blocks) for a member of a stripe set
+                    for n in range(max(1, lastgood + 1), idx + 1):
+                        step = blocknum - base - (idx - n)
+                        if step > n and step % n == 0:
+                            extent, stride = n, step
+                            expected = blocknum
+                            #the hash is for the whole set
+                            hashcheck = False
+                            break
+                if blocknum != expected:
+                    badidx.append(idx)
+                    continue
+                lastgood = idx
+
+                if blocknum == 0:
+                    sbx.decode(bytes(mv[p:p+blocksize]))
+                    metadata = sbx.metadata
+                    if "filesize" in metadata:
+                        datasize = metadata["filesize"]
+                        lastblock = seqbox.getLastBlockNum(metadata,
+                                                            sbx.datasize)
+                    #compressed data can't be hashed block by block
+                    if (full and "hash" in metadata and
+                        not "compress" in metadata):
+                        hashtype, hashdigest = seqbox.decodeMultihash(
+                            metadata["hash"])
+                        if hashtype:
+                            d = hashlib.new(hashtype)
+                            hashcheck = True
+                elif hashcheck and datasize > 0:
+                    data = block[16:16+datasize]
+                    datasize -= len(data)
+                    d.update(data)
+
+    if base is None:
+        base = 1
+    #blocks expected from metadata but not present at all (a stripe
+    #member has just part of them)
+    if extent is None and lastblock >= 0 and blockidx < lastblock + 1 - base:
+        badidx.extend(range(blockidx, lastblock + 1 - base))
+    res["uid"] = binascii.hexlify(uid).decode() if uid else None
+    if extent is None:
+        res["blocks"] = max(blockidx, lastblock + 1 - base)
+    else:
+        res["blocks"] = blockidx
+        res["stripe"] = {"extent":extent * blocksize,
+                         "members":stride // extent}
+    res["badblocks"] = getranges([getblocknum(idx, base, extent, stride)
+                                  for idx in badidx])
+    res["badcount"] = len(badidx)
+    if "filename" in metadata:
+        res["filename"] = metadata["filename"]
+    if badidx:
+        res["status"] = "damaged"
+    if full:
+        if hashcheck:
+            res["hash"] = "match" if d.digest() == hashdigest else "mismatch"
+            if res["hash"] == "mismatch":
+                res["status"] = "damaged"
+        else:
+            res["hash"] = "n/a"
+    return res
+
+
+def main():
+
+    cmdline = get_cmdline()
+
+    filenames = getfilelist(cmdline.filename, cmdline.recurse)
+    if len(filenames) == 0:
+        errexit(1, "nothing to verify!")
+    #the right number of parallel readers depend on the device
+    if cmdline.jobs <= 0:
+        cmdline.jobs = seqbox.getIOConfig(filenames[0])["queuedepth"]
+
+    print("verifying %i SBX file(s) with %i job(s) - %s check..." %
+          (len(filenames), cmdline.jobs, "full" if cmdline.full else "fast"))
+    results = []
+    damaged = 0
+    starttime = time()
+    totsize = 0
+    with ProcessPoolExecutor(max_workers=cmdline.jobs) as executor:
+        tasks = [executor.submit(verify, filename, cmdline.full,
+                                 cmdline.password,
+                                 cmdline.buffer*1024 or
+                                 seqbox.getIOConfig(filename)["readsize"])
+                 for filename in filenames]
+        for task in as_completed(tasks):
+            res = task.result()
+            results.append(res)
+            if res["status"] != "error":
+                totsize += os.path.getsize(res["sbxfilename"])
+            if res["status"] != "ok":
+                damaged += 1
+                if res["status"] == "error":
+                    print("'%s': %s" % (res["sbxfilename"], res["error"]))
+                else:
+                    print("'%s': %i bad block(s)%s%s" %
+                          (res["sbxfilename"], res["badcount"],
+                           " - stripe member" if "stripe" in res else "",
+                           " - hash mismatch!"
+                           if res.get("hash") == "mismatch" else ""))
+            print("%.1f%% - files: %i/%i - damaged: %i" %
+                  (len(results)*100.0/len(filenames), len(results),
+                   len(filenames), damaged), " ", end="\r", flush=True)
+
+    etime = max(time()-starttime, 0.001)
+    print("\nverify completed! - %.2fMB/s" % (totsize/(1024*1024)/etime))
+    results.sort(key=lambda res: res["sbxfilename"])
+    with open(cmdline.report, "w") as frep:
+        json.dump(results, frep, indent=2)
+    print("report saved to '%s'" % (cmdline.report))
+
+    if damaged:
+        errexit(1, "%i SBX file(s) damaged!" % (damaged))
+    print("all SBX files OK!")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+
+#--------------------------------------------------------------------------
+# Block 0 metadata size checks
+#--------------------------------------------------------------------------
+
+import os
+import sys
+import subprocess
+import tempfile
+import unittest
+
+basedir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, basedir)
+
+import seqbox
+
+
+def sbxenc(*args):
+    env = dict(os.environ, SBX_IOCONFIG="")
+    return subprocess.run([sys.executable,
+                           os.path.join(basedir, "sbxenc.py")] + list(args),
+                          capture_output=True, text=True, env=env)
+
+
+class MetadataSizeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.tmpdir.name, "a.bin")
+        with open(self.filename, "wb") as fout:
+            fout.write(os.urandom(5000))
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_encode_refuse_oversized_metadata(self):
+        sbx = seqbox.SbxBlock(ver=2)
+        sbx.metadata = {"filename":"x" * 200}
+        with self.assertRaises(seqbox.SbxError):
+            sbx.encode()
+
+    def test_layout_too_big_for_version(self):
+        sbxfilename = os.path.join(self.tmpdir.name, "a.sbx")
+        res = sbxenc("-sv", "2", "-ht", "1", "-pa", "4,2",
+                     self.filename, sbxfilename)
+        self.assertNotEqual(res.returncode, 0)
+        self.assertIn("can't fit", res.stderr)
+        self.assertFalse(os.path.exists(sbxfilename))
+
+    def test_names_too_long(self):
+        filename = os.path.join(self.tmpdir.name, "n" * 160)
+        os.rename(self.filename, filename)
+        sbxfilename = filename + ".sbx"
+        res = sbxenc("-ha", "blake2b", "-ht", "1", "-pa", "4,2",
+                     filename, sbxfilename)
+        self.assertNotEqual(res.returncode, 0)
+        self.assertIn("names too long", res.stderr)
+        self.assertFalse(os.path.exists(sbxfilename))
+
+    def test_layout_that_fit(self):
+        sbxfilename = os.path.join(self.tmpdir.name, "a.sbx")
+        res = sbxenc("-ha", "blake2b", "-ht", "1", "-pa", "4,2",
+                     self.filename, sbxfilename)
+        self.assertEqual(res.returncode, 0, res.stderr)
+        sbx = seqbox.SbxBlock(ver=1)
+        with open(sbxfilename, "rb") as fin:
+            sbx.decode(fin.read(sbx.blocksize))
+        self.assertEqual(sbx.metadata["filesize"], 5000)
+        self.assertIn("parity", sbx.metadata)
+
+
+if __name__ == '__main__':
+    unittest.main()